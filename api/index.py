@@ -7,6 +7,26 @@ import time
 import uuid
 import json
 
+# Format tracebacks (for the server log, stream error events and JSON error responses)
+# only when API_DEBUG=1; walking the stack is slow on the error path and exposes server
+# internals to the client
+API_DEBUG = os.environ.get('API_DEBUG') == '1'
+
+# The WSGI handler below parses and builds its JSON bodies directly; orjson reads the
+# raw request bytes and returns bytes, so neither direction needs a str round trip
+try:
+    import orjson
+    json_loads = orjson.loads
+    def json_bytes(obj):
+        return orjson.dumps(obj)
+except ImportError:
+    json_loads = json.loads
+    def json_bytes(obj):
+        return json.dumps(obj).encode('utf-8')
+
+# Whether we are running on Vercel, read once at import instead of per request
+IS_VERCEL = bool(os.environ.get('VERCEL', '') or os.environ.get('VERCEL_ENV', ''))
+
 # Add the parent directory to the Python path so we can import from there
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
@@ -21,7 +41,9 @@ except Exception as e:
     @app.route('/', defaults={'path': ''})
     @app.route('/<path:path>')
     def catch_all(path):
-        error_message = f"Error importing server.py: {str(e)}\n\nTraceback: {traceback.format_exc()}"
+        error_message = f"Error importing server.py: {str(e)}"
+        if API_DEBUG:
+            error_message += f"\n\nTraceback: {traceback.format_exc()}"
         return jsonify({"error": error_message}), 500
 else:
     # For Vercel, we need to export the app properly
@@ -63,9 +85,10 @@ else:
             return jsonify(result)
             
         except Exception as e:
-            import traceback
-            traceback_str = traceback.format_exc()
-            print(f"Error in analyze_tokens_route: {str(e)}\n{traceback_str}")
+            traceback_str = traceback.format_exc() if API_DEBUG else None
+            print(f"Error in analyze_tokens_route: {str(e)}")
+            if traceback_str:
+                print(traceback_str)
             return jsonify({
                 "error": f"Error analyzing tokens: {str(e)}",
                 "traceback": traceback_str
@@ -104,8 +127,10 @@ else:
     @app.errorhandler(Exception)
     def handle_exception(e):
         # Log the stack trace
-        traceback_str = traceback.format_exc()
-        print(f"Unhandled exception: {str(e)}\n{traceback_str}")
+        traceback_str = traceback.format_exc() if API_DEBUG else None
+        print(f"Unhandled exception: {str(e)}")
+        if traceback_str:
+            print(traceback_str)
         
         # Special handling for Anthropic client errors
         if "Anthropic" in str(e) and "proxies" in str(e):
@@ -173,10 +198,9 @@ else:
                 'request_headers': dict(request.headers)
             })
         except Exception as e:
-            import traceback
             return jsonify({
                 'error': str(e),
-                'traceback': traceback.format_exc()
+                'traceback': traceback.format_exc() if API_DEBUG else None
             }), 500
 
 # This allows the file to be run directly
@@ -214,10 +238,10 @@ def handler(environ, start_response):
                 
                 if not request_body:
                     # Return error for empty request
-                    json_response = json.dumps({
+                    json_response = json_bytes({
                         "valid": False,
                         "message": "Empty request body"
-                    }).encode('utf-8')
+                    })
                     
                     start_response('400 Bad Request', [
                         ('Content-Type', 'application/json'),
@@ -227,15 +251,15 @@ def handler(environ, start_response):
                     return [json_response]
                 
                 # Parse JSON request
-                data = json.loads(request_body)
+                data = json_loads(request_body)
                 api_key = data.get('api_key', '')
                 
                 # Basic validation only - no imports
                 if not api_key:
-                    json_response = json.dumps({
+                    json_response = json_bytes({
                         "valid": False,
                         "message": "API key is required"
-                    }).encode('utf-8')
+                    })
                     
                     start_response('400 Bad Request', [
                         ('Content-Type', 'application/json'),
@@ -246,10 +270,10 @@ def handler(environ, start_response):
                 
                 # Very simple format check - does it start with sk-ant?
                 if not api_key.startswith('sk-ant'):
-                    json_response = json.dumps({
+                    json_response = json_bytes({
                         "valid": False,
                         "message": "API key format is invalid. It should start with 'sk-ant'"
-                    }).encode('utf-8')
+                    })
                     
                     start_response('400 Bad Request', [
                         ('Content-Type', 'application/json'),
@@ -259,10 +283,10 @@ def handler(environ, start_response):
                     return [json_response]
                 
                 # If we get here, key format is valid
-                json_response = json.dumps({
+                json_response = json_bytes({
                     "valid": True,
                     "message": "API key format is valid"
-                }).encode('utf-8')
+                })
                 
                 start_response('200 OK', [
                     ('Content-Type', 'application/json'),
@@ -273,10 +297,10 @@ def handler(environ, start_response):
                 
             except Exception as e:
                 # Ensure any error in validate-key returns proper JSON
-                error_json = json.dumps({
+                error_json = json_bytes({
                     "valid": False,
                     "message": f"API key validation error: {str(e)}"
-                }).encode('utf-8')
+                })
                 
                 start_response('500 Internal Server Error', [
                     ('Content-Type', 'application/json'),
@@ -290,10 +314,10 @@ def handler(environ, start_response):
             return flask_app(environ, start_response)
         except Exception as e:
             # Handle any Flask errors
-            error_json = json.dumps({
+            error_json = json_bytes({
                 "valid": False,
                 "message": f"Server error: {str(e)}"
-            }).encode('utf-8')
+            })
             
             start_response('500 Internal Server Error', [
                 ('Content-Type', 'application/json'),
@@ -305,10 +329,10 @@ def handler(environ, start_response):
     except Exception as e:
         # Last resort error handler - this should never fail
         try:
-            error_json = json.dumps({
+            error_json = json_bytes({
                 "valid": False,
                 "message": f"Critical server error: {str(e)}"
-            }).encode('utf-8')
+            })
             
             start_response('500 Internal Server Error', [
                 ('Content-Type', 'application/json'),
@@ -347,7 +371,7 @@ def validate_key():
         
         # For Vercel, bypass the actual client validation
         # Just perform simple format check since we don't want to import Anthropic in serverless
-        if os.environ.get('VERCEL', '') or os.environ.get('VERCEL_ENV', ''):
+        if IS_VERCEL:
             print("Running on Vercel, using simplified API key validation")
             return jsonify({
                 "valid": True,
@@ -496,7 +520,7 @@ def process_stream():
                     betas=[OUTPUT_128K_BETA],  # Using betas parameter instead of headers
                 ) as stream:
                     message_id = str(uuid.uuid4())
-                    generated_text = ""
+                    generated_parts = []  # joined once at the end instead of repeated +=
                     
                     for chunk in stream:
                         # Check for timeout approaching
@@ -532,9 +556,11 @@ def process_stream():
                                     "text": chunk.delta.text
                                 }
                             }
-                            generated_text += chunk.delta.text
+                            generated_parts.append(chunk.delta.text)
                             yield f"data: {json.dumps(content_data)}\n\n"
                     
+                    generated_text = "".join(generated_parts)
+                    
                     # Message complete with usage stats
                     usage_data = None
                     if hasattr(stream, "usage"):
@@ -561,8 +587,10 @@ def process_stream():
                 error_data = {
                     "type": "error",
                     "error": str(e),
-                    "traceback": traceback.format_exc()
+                    "error_type": type(e).__name__
                 }
+                if API_DEBUG:
+                    error_data["traceback"] = traceback.format_exc()
                 yield f"data: {json.dumps(error_data)}\n\n"
                 
         return Response(generate(), mimetype='text/event-stream')
@@ -572,7 +600,7 @@ def process_stream():
         error_response = {
             "success": False,
             "error": f"Processing failed: {error_message}",
-            "traceback": traceback.format_exc()
+            "traceback": traceback.format_exc() if API_DEBUG else None
         }
         return jsonify(error_response)
 
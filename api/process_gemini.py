@@ -1,9 +1,24 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 import os
 import sys
-import json
 import traceback
 import time
+import re
+import random
+from html import escape
+import logging
+
+# Requests are logged through the logging module at LOG_LEVEL (INFO by default), with
+# arguments formatted only when a record is actually emitted. The level is set on this
+# module's logger rather than the root, and a handler is attached only when the host
+# has not configured logging (serverless runtimes import the module as-is), so info
+# records such as cache hits and retries are not dropped.
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+if not logging.getLogger().handlers:
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    logger.addHandler(stream_handler)
 
 # Add the parent directory to sys.path
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -17,15 +32,86 @@ GEMINI_TEMPERATURE = 1.0
 GEMINI_TOP_P = 0.95
 GEMINI_TOP_K = 64
 
+# Client-side deadline (seconds) for non-streaming Gemini calls; on Vercel it stays under
+# the function timeout, so the error response still reaches the client
+GEMINI_TIMEOUT = float(os.environ.get('GEMINI_TIMEOUT') or (55 if os.environ.get('VERCEL') else 600))
+
+# Default generation config, built once; see gemini_generation_config
+GEMINI_GENERATION_CONFIG = {
+    "max_output_tokens": GEMINI_MAX_OUTPUT_TOKENS,
+    "temperature": GEMINI_TEMPERATURE,
+    "top_p": GEMINI_TOP_P,
+    "top_k": GEMINI_TOP_K
+}
+
+# Stack frames rendered in error tracebacks
+TRACEBACK_LIMIT = 10
+
+# Error responses carry a traceback in "details" only when GEMINI_DEBUG=1; otherwise it is
+# just logged, so production neither formats it per response nor exposes it to clients
+GEMINI_DEBUG = os.environ.get('GEMINI_DEBUG') == '1'
+
+# Maximum (estimated) tokens of user content sent to Gemini; about 100000 characters of ASCII
+CONTENT_TOKEN_BUDGET = int(os.environ.get('GEMINI_CONTENT_TOKEN_BUDGET', '25000'))
+
+# Maximum number of documents marshaled into one /api/process-gemini-batch call
+GEMINI_BATCH_MAX = 8
+
+# Delimiters around each document in a batch prompt and each page in the reply
+BATCH_DOC_TEMPLATE = "<<<DOC_{index}>>>\n{content}\n<<</DOC_{index}>>>"
+BATCH_HTML_PATTERN = re.compile(r"<<<HTML_(\d+)>>>(.*?)<<</HTML_\1>>>", re.DOTALL)
+
+# Opt-in (GEMINI_LOCAL_RENDER=1): plain-text content shorter than LOCAL_RENDER_MAX_CHARS, sent
+# without a format prompt, is rendered with LOCAL_PAGE_TEMPLATE instead of a Gemini call
+LOCAL_RENDER_ENABLED = os.environ.get('GEMINI_LOCAL_RENDER') == '1'
+LOCAL_RENDER_MAX_CHARS = 500
+HTML_TAG_PATTERN = re.compile(r"<[a-zA-Z][a-zA-Z0-9]*[\s/>]")
+LOCAL_PAGE_TEMPLATE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Generated Content</title>
+    <link href="https://cdn.jsdelivr.net/npm/tailwindcss@2.2.19/dist/tailwind.min.css" rel="stylesheet">
+</head>
+<body class="bg-gray-100 dark:bg-gray-900 text-gray-800 dark:text-gray-200">
+    <div class="container mx-auto p-8 max-w-3xl">
+        <div class="bg-white dark:bg-gray-800 p-6 rounded-lg shadow-lg">
+            <pre class="whitespace-pre-wrap font-sans leading-relaxed">{body}</pre>
+        </div>
+    </div>
+    <script>
+        if (window.matchMedia && window.matchMedia('(prefers-color-scheme: dark)').matches) {{
+            document.documentElement.classList.add('dark');
+        }}
+    </script>
+</body>
+</html>
+"""
+
+# Attempts per non-streaming Gemini call. All attempts share one GEMINI_TIMEOUT budget,
+# and no retry starts with less than GEMINI_RETRY_MIN_REMAINING seconds of it left.
+GEMINI_RETRY_ATTEMPTS = 2
+GEMINI_RETRY_MIN_REMAINING = 5.0
+
+# Seconds without a chunk from Gemini before a keepalive is sent to the client
+GEMINI_HEARTBEAT_INTERVAL = 2.0
+# Seconds between SSE_FLUSH ticks while Gemini is quiet (coalesce_sse's default max_delay)
+GEMINI_FLUSH_INTERVAL = 0.1
+
 # Import helper functions
+# helper_function probes for the google-generativeai package; its GEMINI_AVAILABLE is reused here
 try:
-    from helper_function import create_gemini_client
-    import google.generativeai as genai
-    GEMINI_AVAILABLE = True
-    print("Google Generative AI module is available")
+    from helper_function import GEMINI_AVAILABLE, get_gemini_model, parse_gemini_request, load_json_body, SSEEncoder, format_stream_event, stream_start_event, gemini_usage_tokens, coalesce_sse, iter_with_heartbeat, SSE_PING, SSE_FLUSH, estimate_tokens, extract_gemini_text, gemini_generation_config, forget_gemini_models_on_auth_error, use_orjson_for_jsonify, truncate_to_token_budget, select_gemini_model, gemini_key_hash, response_cache_key, get_cached_response, cache_response, SEMANTIC_CACHE_ENABLED, SEMANTIC_CACHE
+    from google.api_core.exceptions import DeadlineExceeded, ServiceUnavailable, InternalServerError
+    # Failures worth one more attempt with the same parameters
+    RETRYABLE_GEMINI_ERRORS = (DeadlineExceeded, ServiceUnavailable, InternalServerError)
 except ImportError:
     GEMINI_AVAILABLE = False
-    print("Google Generative AI module is not installed")
+if GEMINI_AVAILABLE:
+    logger.info("Google Generative AI module is available")
+else:
+    logger.warning("Google Generative AI module is not installed")
 
 # System instruction
 SYSTEM_INSTRUCTION = """
@@ -33,157 +119,186 @@ You are a web developer specialized in converting content into beautiful, access
 Generate a single-page website from the given content.
 """
 
+# Estimated token count of the system instruction, computed once at import
+SYSTEM_INSTRUCTION_TOKENS = estimate_tokens(SYSTEM_INSTRUCTION) if GEMINI_AVAILABLE else 0
+
 # Initialize Flask app
 app = Flask(__name__)
+if GEMINI_AVAILABLE:
+    use_orjson_for_jsonify(app)  # jsonify() encodes with orjson when installed
+
+def generate_with_retry(model, prompt, generation_config, deadline=None):
+    """
+    Non-streaming generate_content that retries transient Gemini failures (deadline, 500, 503)
+    with jittered exponential backoff, as long as the shared time budget allows.
+    deadline is a time.monotonic() value; by default the call gets GEMINI_TIMEOUT seconds.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + GEMINI_TIMEOUT
+    for attempt in range(GEMINI_RETRY_ATTEMPTS):
+        try:
+            return model.generate_content(
+                prompt,
+                generation_config=generation_config,
+                request_options={"timeout": max(1.0, deadline - time.monotonic())}
+            )
+        except RETRYABLE_GEMINI_ERRORS as e:
+            delay = 0.25 * (2 ** attempt) + random.random() * 0.1
+            if attempt + 1 >= GEMINI_RETRY_ATTEMPTS or deadline - time.monotonic() - delay < GEMINI_RETRY_MIN_REMAINING:
+                raise
+            logger.warning("Transient Gemini error (%s), retrying in %.2fs", e, delay)
+            time.sleep(delay)
 
 def handler(request):
     """
-    Process a file using the Google Gemini API and return HTML.
+    Process a file using the Google Gemini API and stream the HTML back as SSE.
     """
     # Get the data from the request
-    print("\n==== API PROCESS GEMINI REQUEST RECEIVED ====")
+    logger.info("==== API PROCESS GEMINI REQUEST RECEIVED ====")
     
     try:
-        data = request.get_json()
-        
-        if not data:
-            return jsonify({"error": "No data provided"}), 400
-        
-        # Extract the API key and content
-        api_key = data.get('api_key')
-        content = data.get('content', '')
-        format_prompt = data.get('format_prompt', '')
-        max_tokens = int(data.get('max_tokens', GEMINI_MAX_OUTPUT_TOKENS))
-        temperature = float(data.get('temperature', GEMINI_TEMPERATURE))
-        
-        print(f"Processing Gemini request with max_tokens={max_tokens}, content_length={len(content) if content else 0}")
-        
-        # Check if we have the required data
-        if not api_key or not content:
-            return jsonify({'error': 'API key and content are required'}), 400
-        
         # Check if Gemini is available
         if not GEMINI_AVAILABLE:
             return jsonify({
                 'error': 'Google Generative AI package is not installed on the server.'
             }), 500
         
-        # Use our helper function to create a Gemini client
-        client = create_gemini_client(api_key)
+        # Extract and validate the request data (shared with the other Gemini endpoints)
+        params, error_msg = parse_gemini_request(load_json_body(request.get_data()), GEMINI_MAX_OUTPUT_TOKENS, GEMINI_TEMPERATURE)
+        if error_msg:
+            return jsonify({'error': error_msg}), 400
+        
+        api_key = params['api_key']
+        content = params['content']
+        format_prompt = params['format_prompt']
+        max_tokens = params['max_tokens']
+        temperature = params['temperature']
+        model_name = select_gemini_model(params['model'], content, GEMINI_MODEL)
+        session_id = params['session_id']
+        
+        logger.info("Processing Gemini request with max_tokens=%d, content_length=%d", max_tokens, len(content))
+        
+        # Check if we have the required data
+        if not api_key:
+            return jsonify({'error': 'API key and content are required'}), 400
         
-        # Prepare user message with content and additional prompt
-        user_content = content
+        # Prepare user message with content and additional prompt; the content is
+        # only sliced (copied) when it is over the token budget, like the other endpoints
+        user_content = truncate_to_token_budget(content, CONTENT_TOKEN_BUDGET)
         if format_prompt:
             user_content = f"{user_content}\n\n{format_prompt}"
         
-        print("Creating Gemini model...")
+        logger.info("Creating Gemini model...")
         
-        # Get the model
-        model = client.get_model(GEMINI_MODEL)
+        # Get the model (cached per API key across requests); SYSTEM_INSTRUCTION is bound
+        # to it and sent in Gemini's system slot, so the prompt is just the user content
+        model = get_gemini_model(api_key, model_name, SYSTEM_INSTRUCTION)
         
         # Configure generation parameters
-        generation_config = {
-            "max_output_tokens": max_tokens,
-            "temperature": temperature,
-            "top_p": GEMINI_TOP_P,
-            "top_k": GEMINI_TOP_K
-        }
+        generation_config = gemini_generation_config(GEMINI_GENERATION_CONFIG, max_tokens, temperature)
         
         # Create the prompt
-        prompt = f"""
-{SYSTEM_INSTRUCTION}
-
-Here is the content to transform into a website:
-
-{user_content}
-"""
+        prompt = user_content
         
-        # Generate content
-        try:
-            print("Generating content with Gemini (non-streaming)")
-            response = model.generate_content(
-                prompt,
-                generation_config=generation_config
-            )
+        # Stream the generation so the client gets the first tokens as soon as Gemini
+        # produces them, instead of waiting (and holding the connection idle) for the full page
+        def generate():
+            yield stream_start_event(session_id)
             
-            # Extract the HTML from the response using multiple methods
-            html_content = ""
+            encoder = SSEEncoder(session_id)
+            html_parts = []  # joined once for the final event
+            chunk_count = 0
             
             try:
-                # Try standard text attribute first
-                if hasattr(response, 'text'):
-                    html_content = response.text
-                    print(f"Extracted content from text attribute: {len(html_content)} chars")
-                # Then try parts
-                elif hasattr(response, 'parts') and response.parts:
-                    for part in response.parts:
-                        if hasattr(part, 'text'):
-                            html_content += part.text
-                    print(f"Extracted content from parts: {len(html_content)} chars")
-                # Then check candidates
-                elif hasattr(response, 'candidates') and response.candidates:
-                    for candidate in response.candidates:
-                        if hasattr(candidate, 'content') and candidate.content:
-                            if hasattr(candidate.content, 'parts') and candidate.content.parts:
-                                for part in candidate.content.parts:
-                                    if hasattr(part, 'text'):
-                                        html_content += part.text
-                    print(f"Extracted content from candidates: {len(html_content)} chars")
+                logger.info("Generating content with Gemini (streaming)")
+                response = model.generate_content(
+                    prompt,
+                    generation_config=generation_config,
+                    stream=True
+                )
+                
+                # Gemini can go quiet for a few seconds while it buffers a large chunk. Tick
+                # during those gaps so coalesce_sse sends buffered text on time, and send a
+                # keepalive every GEMINI_HEARTBEAT_INTERVAL so proxies don't treat the stream as idle
+                quiet_time = 0.0
+                for chunk in iter_with_heartbeat(response, GEMINI_FLUSH_INTERVAL):
+                    if chunk is None:
+                        quiet_time += GEMINI_FLUSH_INTERVAL
+                        if quiet_time >= GEMINI_HEARTBEAT_INTERVAL:
+                            quiet_time = 0.0
+                            yield SSE_PING
+                        else:
+                            yield SSE_FLUSH
+                        continue
+                    quiet_time = 0.0
+                    
+                    chunk_text = extract_gemini_text(chunk)
+                    
+                    if not chunk_text:
+                        continue
+                    
+                    chunk_count += 1
+                    html_parts.append(chunk_text)
+                    yield encoder.content_delta(chunk_text, chunk_count)
+                
+                html_content = "".join(html_parts)
+                
+                # If we still don't have content, this is an error
+                if not html_content:
+                    raise ValueError("Could not extract content from Gemini response")
+                
+                # Use the token counts Gemini reports on the final chunk when available
+                usage_tokens = gemini_usage_tokens(getattr(response, 'usage_metadata', None))
+                if usage_tokens:
+                    input_tokens, output_tokens, _ = usage_tokens
                 else:
-                    # Last resort: try string conversion
-                    html_content = str(response)
-                    print(f"Extracted content using string conversion: {len(html_content)} chars")
-            except Exception as extract_error:
-                print(f"Error extracting content: {str(extract_error)}")
-                # Try the resolve method as a fallback
-                try:
-                    if hasattr(response, 'resolve'):
-                        resolved = response.resolve()
-                        if hasattr(resolved, 'text'):
-                            html_content = resolved.text
-                            print(f"Extracted content through resolve: {len(html_content)} chars")
-                except Exception as resolve_error:
-                    print(f"Error resolving response: {str(resolve_error)}")
-            
-            # If we still don't have content, this is an error
-            if not html_content:
-                raise ValueError("Could not extract content from Gemini response")
+                    # Approximate counts from the text length (no word list built)
+                    input_tokens = SYSTEM_INSTRUCTION_TOKENS + estimate_tokens(prompt)
+                    output_tokens = estimate_tokens(html_content)
+                
+                # Log response
+                logger.info("Successfully generated HTML with Gemini. Input tokens: %d, Output tokens: %d", input_tokens, output_tokens)
+                
+                # Terminal event with the full HTML and usage
+                yield format_stream_event("content", {
+                    "type": "message_complete",
+                    "html": html_content,
+                    "model": model_name,
+                    "usage": {
+                        "input_tokens": input_tokens,
+                        "output_tokens": output_tokens,
+                        "total_tokens": input_tokens + output_tokens,
+                        "total_cost": 0.0  # Gemini API is currently free
+                    },
+                    "session_id": session_id,
+                    "final_chunk_count": chunk_count
+                })
+                yield format_stream_event("stream_end", {
+                    "message": "Stream complete",
+                    "session_id": session_id
+                })
             
-            # Get usage stats (approximate since Gemini doesn't provide exact token counts)
-            input_tokens = max(1, int(len(prompt.split()) * 1.3))
-            output_tokens = max(1, int(len(html_content.split()) * 1.3))
-            
-            # Log response
-            print(f"Successfully generated HTML with Gemini. Input tokens: {input_tokens}, Output tokens: {output_tokens}")
-            
-            # Return the response
-            return jsonify({
-                'html': html_content,
-                'model': GEMINI_MODEL,
-                'usage': {
-                    'input_tokens': input_tokens,
-                    'output_tokens': output_tokens,
-                    'total_tokens': input_tokens + output_tokens,
-                    'total_cost': 0.0  # Gemini API is currently free
-                }
-            })
+            except Exception as e:
+                error_message = str(e)
+                logger.error("Error in /api/process-gemini: %s", error_message, exc_info=True)
+                forget_gemini_models_on_auth_error(e, api_key)
+                yield format_stream_event("error", {
+                    "type": "error",
+                    "error": f"Server error: {error_message}"
+                })
         
-        except Exception as e:
-            error_message = str(e)
-            print(f"Error in /api/process-gemini: {error_message}")
-            print(traceback.format_exc())
-            return jsonify({
-                'error': f'Server error: {error_message}',
-                'details': traceback.format_exc()
-            }), 500
+        return Response(
+            stream_with_context(coalesce_sse(generate())),
+            content_type='text/event-stream',
+            headers={'X-Session-Id': session_id}
+        )
     
     except Exception as e:
         error_message = str(e)
-        print(f"Error in /api/process-gemini: {error_message}")
-        print(traceback.format_exc())
+        logger.error("Error in /api/process-gemini: %s", error_message, exc_info=True)
         return jsonify({
             'error': f'Server error: {error_message}',
-            'details': traceback.format_exc()
+            'details': traceback.format_exc(limit=TRACEBACK_LIMIT) if GEMINI_DEBUG else None
         }), 500
 
 @app.route('/api/process-gemini', methods=['POST'])
@@ -192,26 +307,6 @@ def process_gemini():
     Process a request using Google Gemini API (non-streaming version).
     """
     try:
-        # Get the request data
-        data = request.get_json()
-        
-        # Extract the API key and content
-        api_key = data.get('api_key')
-        
-        # Check for both 'content' and 'source' parameters for compatibility
-        content = data.get('content', '')
-        if not content:
-            content = data.get('source', '')  # Fallback to 'source' if 'content' is empty
-        
-        # If neither content nor source is provided, return an error
-        if not content:
-            return jsonify({"success": False, "error": "Source code or text is required"}), 400
-        
-        # Extract other parameters with defaults
-        format_prompt = data.get('format_prompt', '')
-        max_tokens = int(data.get('max_tokens', GEMINI_MAX_OUTPUT_TOKENS))
-        temperature = float(data.get('temperature', GEMINI_TEMPERATURE))
-        
         # Check if Gemini is available
         if not GEMINI_AVAILABLE:
             return jsonify({
@@ -220,90 +315,101 @@ def process_gemini():
                 "details": "Please install the package with: pip install google-generativeai"
             }), 500
         
-        # Create Gemini client
+        # Extract and validate the request data (shared with the other Gemini endpoints)
+        params, error_msg = parse_gemini_request(load_json_body(request.get_data()), GEMINI_MAX_OUTPUT_TOKENS, GEMINI_TEMPERATURE)
+        if error_msg:
+            return jsonify({"success": False, "error": error_msg}), 400
+        
+        api_key = params['api_key']
+        content = params['content']
+        format_prompt = params['format_prompt']
+        max_tokens = params['max_tokens']
+        temperature = params['temperature']
+        model_name = select_gemini_model(params['model'], content, GEMINI_MODEL)
+        
+        # Get the Gemini model (cached per API key across requests), with the system instruction bound to it
         try:
-            client = create_gemini_client(api_key)
-            print(f"Created Gemini client with API key: {api_key[:4]}...")
+            model = get_gemini_model(api_key, model_name, SYSTEM_INSTRUCTION)
+            logger.info("Got Gemini model with API key: %s...", api_key[:4])
         except Exception as e:
             return jsonify({
                 "success": False,
                 "error": f"API key validation failed: {str(e)}"
             }), 400
         
-        # Prepare the prompt
-        prompt = f"""
-{SYSTEM_INSTRUCTION}
-
-Here is the content to transform into a website:
-
-{content[:100000]}
-"""
-        
+        # Prepare the prompt; content is only sliced (copied) when it is over the limit.
+        # The system instruction is bound to the model, so the prompt is just the user content.
+        content = truncate_to_token_budget(content, CONTENT_TOKEN_BUDGET)
+        prompt = content
         if format_prompt:
-            prompt += f"\n\n{format_prompt}"
+            prompt = "".join((content, "\n\n", format_prompt))
         
-        print(f"Prepared prompt for Gemini with length: {len(prompt)}")
+        logger.info("Prepared prompt for Gemini with length: %d", len(prompt))
         
         # Start timing the request
         start_time = time.time()
         
+        # Tiny plain-text snippets can be rendered locally instead of by the model (opt-in)
+        if (LOCAL_RENDER_ENABLED and not format_prompt and len(content) < LOCAL_RENDER_MAX_CHARS
+                and not HTML_TAG_PATTERN.search(content)):
+            logger.info("Rendering short plain-text content with the local template")
+            return jsonify({
+                "success": True,
+                "html": LOCAL_PAGE_TEMPLATE.format(body=escape(content)),
+                "model": "local-template",
+                "stats": {
+                    "time_taken": time.time() - start_time,
+                    "input_tokens": 0,
+                    "output_tokens": 0,
+                    "total_tokens": 0
+                }
+            })
+        
+        # An identical earlier request is answered from the response cache
+        cache_key = response_cache_key(gemini_key_hash(api_key), model_name, max_tokens, temperature, content, format_prompt)
+        cached_html = get_cached_response(cache_key)
+        if cached_html is not None:
+            logger.info("Serving Gemini result from the response cache")
+            return jsonify({
+                "success": True,
+                "html": cached_html,
+                "stats": {
+                    "time_taken": time.time() - start_time,
+                    "input_tokens": 0,
+                    "output_tokens": 0,
+                    "total_tokens": 0
+                }
+            }), 200, {'X-Cache': 'HIT'}
+        
+        # Near-duplicate content can be answered from the semantic cache (opt-in)
+        semantic_bucket = response_cache_key(gemini_key_hash(api_key), model_name, max_tokens, temperature, format_prompt)
+        semantic_vector = SEMANTIC_CACHE.embed(api_key, content) if SEMANTIC_CACHE_ENABLED else None
+        if semantic_vector is not None:
+            similar_html = SEMANTIC_CACHE.lookup(semantic_bucket, semantic_vector, content)
+            if similar_html is not None:
+                return jsonify({
+                    "success": True,
+                    "html": similar_html,
+                    "stats": {
+                        "time_taken": time.time() - start_time,
+                        "input_tokens": 0,
+                        "output_tokens": 0,
+                        "total_tokens": 0
+                    }
+                }), 200, {'X-Cache': 'SEMANTIC'}
+        
         try:
-            # Get the model
-            model = client.get_model(GEMINI_MODEL)
-            
             # Set up generation config
-            generation_config = {
-                "max_output_tokens": max_tokens,
-                "temperature": temperature,
-                "top_p": GEMINI_TOP_P,
-                "top_k": GEMINI_TOP_K
-            }
+            generation_config = gemini_generation_config(GEMINI_GENERATION_CONFIG, max_tokens, temperature)
             
             # Generate content
-            response = model.generate_content(
-                prompt,
-                generation_config=generation_config
-            )
+            response = generate_with_retry(model, prompt, generation_config)
             
             # Extract the content
-            html_content = ""
-            
-            # Try multiple methods to extract text from the response
-            try:
-                if hasattr(response, 'text'):
-                    html_content = response.text
-                    print(f"Extracted text from 'text' attribute: {len(html_content)} chars")
-                elif hasattr(response, 'parts') and response.parts:
-                    html_content = response.parts[0].text
-                    print(f"Extracted text from 'parts' attribute: {len(html_content)} chars")
-                elif hasattr(response, 'candidates') and response.candidates:
-                    for candidate in response.candidates:
-                        if hasattr(candidate, 'content') and candidate.content:
-                            if hasattr(candidate.content, 'parts') and candidate.content.parts:
-                                for part in candidate.content.parts:
-                                    if hasattr(part, 'text'):
-                                        html_content += part.text
-                    print(f"Extracted text from 'candidates' attribute: {len(html_content)} chars")
-                else:
-                    # Last resort: convert the entire response to string
-                    html_content = str(response)
-                    print(f"Extracted text using string conversion: {len(html_content)} chars")
-            except Exception as text_error:
-                print(f"Error extracting text: {str(text_error)}")
-                try:
-                    if hasattr(response, 'resolve'):
-                        resolved = response.resolve()
-                        if hasattr(resolved, 'text'):
-                            html_content = resolved.text
-                            print(f"Extracted text through resolve: {len(html_content)} chars")
-                        elif hasattr(resolved, 'parts') and resolved.parts:
-                            html_content = resolved.parts[0].text
-                            print(f"Extracted text through resolve: {len(html_content)} chars")
-                except Exception as resolve_error:
-                    print(f"Error resolving response: {str(resolve_error)}")
+            html_content = extract_gemini_text(response)
             
             # Log length of content
-            print(f"Extracted content length: {len(html_content)}")
+            logger.info("Extracted content length: %d", len(html_content))
             
             # If no content was extracted, raise an error
             if not html_content:
@@ -313,11 +419,15 @@ Here is the content to transform into a website:
             end_time = time.time()
             time_taken = end_time - start_time
             
-            # Calculate tokens used (approximate)
-            input_tokens = max(1, int(len(prompt.split()) * 1.3))
-            output_tokens = max(1, int(len(html_content.split()) * 1.3))
+            # Calculate tokens used (approximate, from the text length)
+            input_tokens = SYSTEM_INSTRUCTION_TOKENS + estimate_tokens(prompt)
+            output_tokens = estimate_tokens(html_content)
             total_tokens = input_tokens + output_tokens
             
+            cache_response(cache_key, html_content)
+            if semantic_vector is not None:
+                SEMANTIC_CACHE.add(semantic_bucket, semantic_vector, content, html_content)
+            
             # Return the result
             return jsonify({
                 "success": True,
@@ -328,26 +438,149 @@ Here is the content to transform into a website:
                     "output_tokens": output_tokens,
                     "total_tokens": total_tokens
                 }
-            })
+            }), 200, {'X-Cache': 'MISS'}
             
         except Exception as generate_error:
             error_message = str(generate_error)
-            print(f"Error generating content: {error_message}")
-            print(traceback.format_exc())
+            logger.error("Error generating content: %s", error_message, exc_info=True)
+            forget_gemini_models_on_auth_error(generate_error, api_key)
             
+            # A call that hit the local deadline is reported as a gateway timeout
+            status_code = 504 if isinstance(generate_error, DeadlineExceeded) else 500
             return jsonify({
                 "success": False,
                 "error": f"Generation error: {error_message}",
-                "details": traceback.format_exc()
-            }), 500
+                "details": traceback.format_exc(limit=TRACEBACK_LIMIT) if GEMINI_DEBUG else None
+            }), status_code
             
     except Exception as request_error:
         error_message = str(request_error)
-        print(f"Request error: {error_message}")
-        print(traceback.format_exc())
+        logger.error("Request error: %s", error_message, exc_info=True)
         
         return jsonify({
             "success": False,
             "error": f"Request error: {error_message}",
-            "details": traceback.format_exc()
-        }), 500 
\ No newline at end of file
+            "details": traceback.format_exc(limit=TRACEBACK_LIMIT) if GEMINI_DEBUG else None
+        }), 500 
+
+@app.route('/api/process-gemini-batch', methods=['POST'])
+def process_gemini_batch():
+    """
+    Process several documents with one Gemini call (non-streaming).
+    The documents are marshaled into a single prompt, so the system instruction and the
+    request overhead are paid once per batch instead of once per document.
+    """
+    api_key = None  # Set before the try so the auth-error handler below can always read it
+    try:
+        # Check if Gemini is available
+        if not GEMINI_AVAILABLE:
+            return jsonify({
+                "success": False,
+                "error": "Google Generative AI is not available on this server."
+            }), 500
+        
+        data = load_json_body(request.get_data())
+        if not isinstance(data, dict):
+            return jsonify({"success": False, "error": "Request body must be a JSON object"}), 400
+        
+        api_key = data.get('api_key')
+        documents = data.get('documents')
+        if not api_key:
+            return jsonify({"success": False, "error": "API key is required"}), 400
+        if (not isinstance(documents, list) or not documents
+                or not all(isinstance(doc, str) and doc for doc in documents)):
+            return jsonify({"success": False, "error": "documents must be a non-empty list of strings"}), 400
+        if len(documents) > GEMINI_BATCH_MAX:
+            return jsonify({"success": False, "error": f"At most {GEMINI_BATCH_MAX} documents per batch"}), 400
+        
+        try:
+            max_tokens = int(data.get('max_tokens', GEMINI_MAX_OUTPUT_TOKENS))
+            temperature = float(data.get('temperature', GEMINI_TEMPERATURE))
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "error": "max_tokens and temperature must be numbers"}), 400
+        
+        model = get_gemini_model(api_key, GEMINI_MODEL, SYSTEM_INSTRUCTION)
+        generation_config = gemini_generation_config(GEMINI_GENERATION_CONFIG, max_tokens, temperature)
+        
+        # Split the token budget across the batch so the prompt stays the size of a single request
+        doc_budget = CONTENT_TOKEN_BUDGET // len(documents)
+        documents = [truncate_to_token_budget(doc, doc_budget) for doc in documents]
+        
+        prompt_parts = [
+            f"Generate {len(documents)} separate HTML documents, one for each document below. "
+            "Wrap the HTML for document i in <<<HTML_i>>> and <<</HTML_i>>>, and output nothing else."
+        ]
+        prompt_parts.extend(
+            BATCH_DOC_TEMPLATE.format(index=index, content=doc)
+            for index, doc in enumerate(documents, 1)
+        )
+        prompt = "\n\n".join(prompt_parts)
+        
+        start_time = time.time()
+        # One time budget covers the batch call and every per-document fallback
+        deadline = time.monotonic() + GEMINI_TIMEOUT
+        response = generate_with_retry(model, prompt, generation_config, deadline)
+        
+        # Split the reply back into one page per document
+        pages = {int(index): html.strip() for index, html in BATCH_HTML_PATTERN.findall(extract_gemini_text(response))}
+        
+        usage_tokens = gemini_usage_tokens(getattr(response, 'usage_metadata', None))
+        if usage_tokens:
+            input_tokens, output_tokens, _ = usage_tokens
+        else:
+            input_tokens = SYSTEM_INSTRUCTION_TOKENS + estimate_tokens(prompt)
+            output_tokens = sum(estimate_tokens(html) for html in pages.values())
+        
+        results = []
+        for index, doc in enumerate(documents, 1):
+            html_content = pages.get(index)
+            if not html_content:
+                # The batch reply is missing this document; generate it on its own if time allows
+                if deadline - time.monotonic() < GEMINI_RETRY_MIN_REMAINING:
+                    logger.warning("Batch time budget exhausted, skipping fallback for document %d", index)
+                    results.append({"success": False, "error": "Batch time budget exhausted before this document was generated"})
+                    continue
+                logger.warning("Batch reply has no HTML for document %d, retrying it individually", index)
+                try:
+                    single = generate_with_retry(model, doc, generation_config, deadline)
+                    html_content = extract_gemini_text(single)
+                    usage_tokens = gemini_usage_tokens(getattr(single, 'usage_metadata', None))
+                    if usage_tokens:
+                        input_tokens += usage_tokens[0]
+                        output_tokens += usage_tokens[1]
+                    else:
+                        input_tokens += SYSTEM_INSTRUCTION_TOKENS + estimate_tokens(doc)
+                        output_tokens += estimate_tokens(html_content)
+                except Exception as retry_error:
+                    logger.error("Error generating document %d: %s", index, retry_error)
+                    results.append({"success": False, "error": f"Generation error: {str(retry_error)}"})
+                    continue
+            
+            if html_content:
+                results.append({"success": True, "html": html_content})
+            else:
+                results.append({"success": False, "error": "Could not extract content from Gemini response"})
+        
+        return jsonify({
+            "success": True,
+            "results": results,
+            "stats": {
+                "time_taken": time.time() - start_time,
+                "document_count": len(documents),
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens
+            }
+        })
+    
+    except Exception as e:
+        error_message = str(e)
+        logger.error("Error in /api/process-gemini-batch: %s", error_message, exc_info=True)
+        forget_gemini_models_on_auth_error(e, api_key)
+        return jsonify({
+            "success": False,
+            "error": f"Request error: {error_message}"
+        }), 500
+
+if __name__ == '__main__':
+    app.run(port=int(os.environ.get('PORT', 5010)))
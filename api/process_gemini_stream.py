@@ -1,10 +1,10 @@
 from flask import Flask, request, jsonify, Response, stream_with_context
 import os
 import sys
-import json
-import uuid
 import time
-import traceback
+import logging
+
+logger = logging.getLogger(__name__)
 
 # Add the parent directory to sys.path
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -18,15 +18,32 @@ GEMINI_TEMPERATURE = 1.0
 GEMINI_TOP_P = 0.95
 GEMINI_TOP_K = 64
 
+# Client-side deadline (seconds) for non-streaming Gemini calls; on Vercel it stays under
+# the function timeout, so the error response still reaches the client
+GEMINI_TIMEOUT = float(os.environ.get('GEMINI_TIMEOUT') or (55 if os.environ.get('VERCEL') else 600))
+
+# Default generation config, built once; see gemini_generation_config
+GEMINI_GENERATION_CONFIG = {
+    "max_output_tokens": GEMINI_MAX_OUTPUT_TOKENS,
+    "temperature": GEMINI_TEMPERATURE,
+    "top_p": GEMINI_TOP_P,
+    "top_k": GEMINI_TOP_K
+}
+
+# Log full tracebacks for stream errors only when GEMINI_DEBUG=1; formatting them walks
+# the stack, and they never go to the client
+GEMINI_DEBUG = os.environ.get('GEMINI_DEBUG') == '1'
+
 # Import helper functions
+# helper_function probes for the google-generativeai package; its GEMINI_AVAILABLE is reused here
 try:
-    from helper_function import create_gemini_client, GeminiStreamingResponse, format_stream_event
-    import google.generativeai as genai
-    GEMINI_AVAILABLE = True
-    print("Google Generative AI package is available")
+    from helper_function import GEMINI_AVAILABLE, get_gemini_model, format_stream_event, stream_start_event, gemini_usage_tokens, estimate_tokens, parse_gemini_request, load_json_body, coalesce_sse, extract_gemini_text, gemini_generation_config, forget_gemini_models_on_auth_error, use_orjson_for_jsonify, truncate_to_token_budget, select_gemini_model
 except ImportError:
     GEMINI_AVAILABLE = False
-    print("Google Generative AI module is not installed")
+if GEMINI_AVAILABLE:
+    logger.info("Google Generative AI package is available")
+else:
+    logger.warning("Google Generative AI module is not installed")
 
 # System instruction
 SYSTEM_INSTRUCTION = """
@@ -34,8 +51,16 @@ You are a web developer specialized in converting content into beautiful, access
 Generate a single-page website from the given content.
 """
 
+# Estimated token count of the system instruction, computed once at import
+SYSTEM_INSTRUCTION_TOKENS = estimate_tokens(SYSTEM_INSTRUCTION) if GEMINI_AVAILABLE else 0
+
+# Maximum (estimated) tokens of user content sent to Gemini; about 100000 characters of ASCII
+CONTENT_TOKEN_BUDGET = int(os.environ.get('GEMINI_CONTENT_TOKEN_BUDGET', '25000'))
+
 # Initialize Flask app
 app = Flask(__name__)
+if GEMINI_AVAILABLE:
+    use_orjson_for_jsonify(app)  # jsonify() encodes with orjson when installed
 
 # In-memory session cache for handling reconnections
 session_cache = {}
@@ -45,235 +70,176 @@ def handler(request):
     Process a streaming request using Google Gemini API.
     """
     try:
-        # Extract request data
-        data = request.get_json()
-        api_key = data.get('api_key')
-        
-        # Check for both 'content' and 'source' parameters for compatibility
-        content = data.get('content', '')
-        if not content:
-            content = data.get('source', '')  # Fallback to 'source' if 'content' is empty
-        
-        # If content is empty, return an error
-        if not content:
-            return jsonify({"success": False, "error": "Source code or text is required"}), 400
-        
-        format_prompt = data.get('format_prompt', '')
-        max_tokens = int(data.get('max_tokens', GEMINI_MAX_OUTPUT_TOKENS))
-        temperature = float(data.get('temperature', GEMINI_TEMPERATURE))
-        
-        # Reconnection support
-        session_id = data.get('session_id', str(uuid.uuid4()))
-        
         # Check if Gemini is available
         if not GEMINI_AVAILABLE:
             error_msg = 'Google Generative AI package is not installed on the server.'
-            print(f"Error: {error_msg}")
+            logger.error("Error: %s", error_msg)
             return jsonify({
                 'error': error_msg,
                 'details': 'Please install the Google Generative AI package with "pip install google-generativeai"'
             }), 500
         
-        # Create Gemini client
+        # Extract and validate request data in one pass
+        params, error_msg = parse_gemini_request(load_json_body(request.get_data()), GEMINI_MAX_OUTPUT_TOKENS, GEMINI_TEMPERATURE)
+        if error_msg:
+            return jsonify({"success": False, "error": error_msg}), 400
+        
+        api_key = params['api_key']
+        content = params['content']
+        format_prompt = params['format_prompt']
+        max_tokens = params['max_tokens']
+        temperature = params['temperature']
+        model_name = select_gemini_model(params['model'], content, GEMINI_MODEL)
+        session_id = params['session_id']  # Reconnection support
+        
+        # Get the Gemini model (cached per API key, so repeat requests skip client setup)
         try:
-            client = create_gemini_client(api_key)
-            print(f"Gemini client created successfully with API key: {api_key[:4]}...")
+            model = get_gemini_model(api_key, model_name, SYSTEM_INSTRUCTION)
+            logger.info("Gemini model ready for API key: %s...", api_key[:4])
         except Exception as e:
             error_msg = f"API key validation failed: {str(e)}"
-            print(f"Error: {error_msg}")
+            logger.error("Error: %s", error_msg)
             return jsonify({
                 "success": False,
                 "error": error_msg
             })
         
-        # Initialize session cache for this request
-        session_cache[session_id] = {
-            'created_at': time.time(),
-            'last_updated': time.time(),
-            'html_segments': [],
-            'generated_text': '',
-            'chunk_count': 0,
-            'user_content': content[:100000],  # Store for potential reconnection
-            'format_prompt': format_prompt,
-            'model': GEMINI_MODEL,
-            'max_tokens': max_tokens,
-            'temperature': temperature
-        }
-        
-        # Prepare prompt
-        prompt = f"""
-{SYSTEM_INSTRUCTION}
-
-Here is the content to transform into a website:
-
-{content[:100000]}
-"""
-        
-        if format_prompt:
-            prompt += f"\n\n{format_prompt}"
-        
-        print(f"Prepared prompt for Gemini with length: {len(prompt)}")
-        
         # Define the streaming response generator
         def gemini_stream_generator():
             try:
-                yield format_stream_event("stream_start", {"message": "Stream starting", "session_id": session_id})
+                # Send stream_start before any prompt work so the client gets its first byte sooner
+                yield stream_start_event(session_id)
                 
-                # Get the model
-                try:
-                    model = client.get_model(GEMINI_MODEL)
-                    print(f"Successfully retrieved Gemini model: {GEMINI_MODEL}")
-                except Exception as model_error:
-                    error_detail = f"Failed to get Gemini model: {str(model_error)}"
-                    print(f"Error: {error_detail}")
-                    yield format_stream_event("error", {
-                        "type": "error", 
-                        "error": "Model creation failed",
-                        "details": error_detail,
-                        "session_id": session_id
-                    })
-                    return
-                    
-                    # Configure generation parameters
-                    generation_config = {
-                        "max_output_tokens": max_tokens,
-                        "temperature": temperature,
-                        "top_p": GEMINI_TOP_P,
-                        "top_k": GEMINI_TOP_K
-                    }
-                    
-                print(f"Starting Gemini generation with config: {generation_config}")
+                # Truncate once and reuse the result for the cache and the prompt;
+                # the slice copies the string, so it only runs when the content is too long
+                user_content = truncate_to_token_budget(content, CONTENT_TOKEN_BUDGET)
+                if user_content is not content:
+                    logger.info("Truncated content from %s to %s characters", len(content), len(user_content))
+                
+                # Initialize session cache for this request
+                session_cache[session_id] = {
+                    'created_at': time.time(),
+                    'last_updated': time.time(),
+                    'html_segments': [],
+                    'generated_text': '',
+                    'chunk_count': 0,
+                    'user_content': user_content,  # Store for potential reconnection
+                    'format_prompt': format_prompt,
+                    'model': model_name,
+                    'max_tokens': max_tokens,
+                    'temperature': temperature
+                }
+                
+                # Prepare prompt: the system instruction is bound to the cached model,
+                # so the user content is sent as-is unless a format prompt is appended
+                prompt = user_content
+                
+                if format_prompt:
+                    prompt += f"\n\n{format_prompt}"
+                
+                logger.debug("Prepared prompt for Gemini with length: %s", len(prompt))
+                
+                # Estimate input tokens once from the prompt length (used if Gemini reports no usage)
+                input_tokens = SYSTEM_INSTRUCTION_TOKENS + estimate_tokens(prompt)
+                
+                # Configure generation parameters
+                generation_config = gemini_generation_config(GEMINI_GENERATION_CONFIG, max_tokens, temperature)
+                
+                logger.info("Starting Gemini generation with config: %s", generation_config)
                 
                 # Generate content
                 try:
                     # For Vercel, use a simplified non-streaming approach to avoid timeout issues
-                    print("Using simplified non-streaming approach for Vercel compatibility")
+                    logger.info("Using simplified non-streaming approach for Vercel compatibility")
                     
                     # Make a non-streaming request to the Gemini API
                     response = model.generate_content(
                         prompt,
                         generation_config=generation_config,
-                        stream=False  # Force non-streaming for Vercel
+                        stream=False,  # Force non-streaming for Vercel
+                        request_options={"timeout": GEMINI_TIMEOUT}
                     )
                     
                     # Extract the content text directly
-                    content_text = ""
-                    
-                    # Try multiple methods to extract text from the response
-                    try:
-                        if hasattr(response, 'text'):
-                            content_text = response.text
-                            print(f"Extracted text from 'text' attribute: {len(content_text)} chars")
-                        elif hasattr(response, 'parts') and response.parts:
-                            content_text = response.parts[0].text
-                            print(f"Extracted text from 'parts' attribute: {len(content_text)} chars")
-                        elif hasattr(response, 'candidates') and response.candidates:
-                            for candidate in response.candidates:
-                                if hasattr(candidate, 'content') and candidate.content:
-                                    if hasattr(candidate.content, 'parts') and candidate.content.parts:
-                                        for part in candidate.content.parts:
-                                            if hasattr(part, 'text'):
-                                                content_text += part.text
-                            print(f"Extracted text from 'candidates' attribute: {len(content_text)} chars")
-                        else:
-                            # Last resort: convert the entire response to string
-                            content_text = str(response)
-                            print(f"Extracted text using string conversion: {len(content_text)} chars")
-                    except Exception as text_error:
-                        # If all attempts fail, try using the resolve method
-                        print(f"Error extracting text: {str(text_error)}")
-                        try:
-                            if hasattr(response, 'resolve'):
-                                resolved = response.resolve()
-                                if hasattr(resolved, 'text'):
-                                    content_text = resolved.text
-                                    print(f"Extracted text through resolve: {len(content_text)} chars")
-                                elif hasattr(resolved, 'parts') and resolved.parts:
-                                    content_text = resolved.parts[0].text
-                                    print(f"Extracted text through resolve: {len(content_text)} chars")
-                        except Exception as resolve_error:
-                            print(f"Error resolving response: {str(resolve_error)}")
+                    content_text = extract_gemini_text(response)
+                    logger.debug("Extracted %s chars from Gemini response", len(content_text))
                     
                     # If we still don't have content, this is an error
                     if not content_text:
                         raise ValueError("Could not extract content from Gemini response")
                     
-                    # Now simulate a stream in the format expected by the client
-                    # 1. Start stream event
-                    yield format_stream_event("stream_start", {"message": "Stream starting", "session_id": session_id})
+                    # Now finish the stream in the format expected by the client (stream_start was
+                    # sent above). The full content goes out once, as the "html" of message_complete;
+                    # the client treats a non-empty message_complete.html as received content
+                    # (static/app.js), so no separate full-content delta is sent.
+                    # 1. Send message complete event, preferring Gemini's exact token counts
+                    usage_tokens = gemini_usage_tokens(getattr(response, 'usage_metadata', None))
+                    if usage_tokens:
+                        prompt_tokens, output_tokens, cached_tokens = usage_tokens
+                    else:
+                        prompt_tokens = input_tokens
+                        output_tokens = estimate_tokens(content_text)
+                        cached_tokens = 0
                     
-                    # 2. Send content delta (the full content at once)
-                    yield format_stream_event("content", {
-                        "type": "content_block_delta",
-                        "delta": {"text": content_text},
-                        "session_id": session_id,
-                        "chunk_id": f"{session_id}_1"
-                    })
-                    
-                    # 3. Send message complete event
-                    input_tokens = max(1, int(len(prompt.split()) * 1.3))
-                    output_tokens = max(1, int(len(content_text.split()) * 1.3))
+                    usage = {
+                        "input_tokens": prompt_tokens,
+                        "output_tokens": output_tokens,
+                        "total_tokens": prompt_tokens + output_tokens,
+                        "total_cost": 0.0
+                    }
+                    if cached_tokens:
+                        usage["cached_tokens"] = cached_tokens
                     
                     yield format_stream_event("content", {
                         "type": "message_complete",
                         "chunk_id": f"{session_id}_complete",
-                        "usage": {
-                            "input_tokens": input_tokens,
-                            "output_tokens": output_tokens,
-                            "total_tokens": input_tokens + output_tokens,
-                            "total_cost": 0.0
-                        },
+                        "usage": usage,
                         "html": content_text,
                         "session_id": session_id
                     })
                     
-                    # 4. Send stream end event
+                    # 2. Send stream end event
                     yield format_stream_event("stream_end", {
                         "message": "Stream complete",
                         "session_id": session_id
                     })
                     
-                    print(f"Successfully processed Gemini response with {len(content_text)} chars")
+                    logger.debug("Successfully processed Gemini response with %s chars", len(content_text))
 
                 except Exception as e:
                     error_message = str(e)
-                    print(f"Error in Gemini processing: {error_message}")
-                    print(traceback.format_exc())
+                    logger.error("Error in Gemini processing: %s", error_message, exc_info=GEMINI_DEBUG)
+                    forget_gemini_models_on_auth_error(e, api_key)
                     
                     # Send error event to client
                     yield format_stream_event("error", {
                         "type": "error",
-                        "error": f"Gemini API error: {error_message}",
-                        "details": traceback.format_exc(),
-                        "session_id": session_id
+                        "error": f"Gemini API error: {error_message}"
                     })
                     
             except Exception as e:
                 error_message = str(e)
-                print(f"Unexpected error in gemini_stream_generator: {error_message}")
-                print(traceback.format_exc())
+                logger.error("Unexpected error in gemini_stream_generator: %s", error_message, exc_info=GEMINI_DEBUG)
                 
                 yield format_stream_event("error", {
                     "type": "error",
-                    "error": error_message,
-                    "details": traceback.format_exc(),
-                    "session_id": session_id
+                    "error": error_message
                 })
         
-        # Return the streaming response
+        # Return the streaming response; coalesce_sse sends adjacent frames
+        # (message_complete and stream_end) in a single write
         return Response(
-            stream_with_context(gemini_stream_generator()),
-            content_type='text/event-stream'
+            stream_with_context(coalesce_sse(gemini_stream_generator())),
+            content_type='text/event-stream',
+            headers={'X-Session-Id': session_id}  # Sent once here instead of in every frame
         )
         
     except Exception as outer_error:
         # Catch any exceptions that might occur outside the generator
         error_message = str(outer_error)
-        print(f"Outer exception in process_gemini_stream: {error_message}")
-        print(traceback.format_exc())
+        logger.error("Outer exception in process_gemini_stream: %s", error_message, exc_info=GEMINI_DEBUG)
         return jsonify({
-            'error': error_message,
-            'details': traceback.format_exc()
+            'error': error_message
         }), 500
 
 @app.route('/api/process-gemini-stream', methods=['POST'])
@@ -1,24 +1,103 @@
 # Helper functions for server.py
-import anthropic
 import os
 import json
 import requests
 import time
 import uuid
-import base64
-import traceback
+import types
+import queue
+import threading
+import hashlib
+import re
+import collections
+import logging
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# numpy makes the semantic cache lookup a single matrix-vector product; optional
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+# Use orjson for SSE payloads when available: it serializes straight to bytes,
+# so events skip both the slower stdlib encoder and a separate str.encode step
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+    def json_bytes(obj):
+        return orjson.dumps(obj)
+    def json_loads(data):
+        return orjson.loads(data)
+except ImportError:
+    ORJSON_AVAILABLE = False
+    def json_bytes(obj):
+        return json.dumps(obj).encode('utf-8')
+    def json_loads(data):
+        return json.loads(data)
+
+def load_json_body(body):
+    """
+    Parse a raw request body (bytes) in one pass, without decoding it to str first.
+    Returns None for an empty or malformed body, like request.get_json(silent=True).
+    """
+    try:
+        return json_loads(body)
+    except ValueError:
+        return None
+
+def use_orjson_for_jsonify(app):
+    """
+    Make jsonify() and request.get_json() on this Flask app use orjson when it is installed.
+    Responses carrying a whole generated page (50-200KB of HTML in one JSON string)
+    are encoded in C straight to bytes; call sites keep using jsonify unchanged.
+    """
+    if not ORJSON_AVAILABLE:
+        return
+    from flask.json.provider import DefaultJSONProvider
+    
+    class OrjsonProvider(DefaultJSONProvider):
+        def loads(self, s, **kwargs):
+            # get_json() hands over the raw body bytes; orjson parses them without a decode pass
+            return orjson.loads(s)
+        
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        
+        def response(self, *args, **kwargs):
+            obj = self._prepare_response_obj(args, kwargs)
+            return self._app.response_class(
+                orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS),
+                mimetype=self.mimetype
+            )
+    
+    app.json = OrjsonProvider(app)
 
 # Import Google Generative AI package
 try:
     import google.generativeai as genai
+    import google.ai.generativelanguage as glm
     GEMINI_AVAILABLE = True
 except ImportError:
     GEMINI_AVAILABLE = False
-    print("Google Generative AI package not available. Some features may be limited.")
+    logger.warning("Google Generative AI package not available. Some features may be limited.")
+
+# Whether we are running on Vercel; the environment does not change after import
+IS_VERCEL = bool(os.environ.get('VERCEL'))
+
+# Shared HTTP session so repeated API calls reuse pooled keep-alive connections
+# instead of paying a fresh TCP + TLS handshake on every request.
+# Auth travels in per-request headers, so one session is safe to share across keys.
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '32'))
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount('https://', HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+HTTP_SESSION.mount('http://', HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
 
 def create_anthropic_client(api_key):
     """Create an Anthropic client with the given API key."""
-    print(f"Creating Anthropic client with API key: {api_key[:8]}...")
+    logger.info("Creating Anthropic client with API key: %s...", api_key[:8])
     
     # Check if API key is valid format
     if not api_key or not api_key.strip():
@@ -26,6 +105,10 @@ def create_anthropic_client(api_key):
     
     # Try to create the client with the standard approach first
     try:
+        # The SDK is imported on first use: the Gemini functions import this module
+        # too, and should not pay for loading the Anthropic SDK on a cold start
+        import anthropic
+        
         # Create client with only the essential parameter
         client = anthropic.Anthropic(api_key=api_key)
         
@@ -35,217 +118,864 @@ def create_anthropic_client(api_key):
             client.count_tokens("Test")
             return client
         except Exception as e:
-            print(f"Warning: Token counting failed but client might still work: {str(e)}")
+            logger.warning("Token counting failed but client might still work: %s", e)
             return client
             
     except Exception as e:
-        print(f"Standard client creation failed: {str(e)}")
+        logger.error("Standard client creation failed: %s", e)
         
         # Try the fallback client approach
         try:
-            print("Using custom Anthropic client implementation")
+            logger.info("Using custom Anthropic client implementation")
             return VercelCompatibleClient(api_key)
         except Exception as e2:
-            print(f"Custom client also failed: {str(e2)}")
+            logger.error("Custom client also failed: %s", e2)
             raise Exception(f"Failed to create Anthropic client: {str(e)}")
 
+def gemini_key_hash(api_key):
+    """SHA-256 of an API key, used wherever a key has to appear in a cache key."""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+# Gemini service clients, one per API key, keyed by the key's hash (least recently used first).
+# Each client carries its own key in client_options, so models built on it can never pick up
+# another request's key the way the process-global genai.configure() default client could.
+GEMINI_CLIENT_CACHE_SIZE = int(os.environ.get('GEMINI_CLIENT_CACHE_SIZE', '32'))
+GEMINI_SERVICE_CLIENTS = collections.OrderedDict()
+GEMINI_SERVICE_CLIENTS_LOCK = threading.Lock()
+
+# A simple wrapper class that provides the methods expected by the server,
+# bound to the service client of a single API key.
+class GeminiClient:
+    def __init__(self, service_client):
+        self.service_client = service_client
+    
+    def get_model(self, model_name, system_instruction=None):
+        """Create and return a GenerativeModel instance for the specified model."""
+        try:
+            model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+            # Bind this key's client now; left unset, genai binds the global default client
+            # (whatever key was configured last) on the model's first call
+            model._client = self.service_client
+            return model
+        except Exception as e:
+            logger.error("Error creating model %s: %s", model_name, e)
+            raise
+
 def create_gemini_client(api_key):
     """Create a Google Gemini client with the given API key."""
     if not GEMINI_AVAILABLE:
         raise ImportError("Google Generative AI package is not installed. Please install it with 'pip install google-generativeai'.")
     
-    print(f"Creating Google Gemini client with API key: {api_key[:8]}...")
-    
     # Check if API key is valid format
     if not api_key or not api_key.strip():
         raise ValueError("API key cannot be empty")
     
+    key_hash = gemini_key_hash(api_key)
     try:
-        # Configure the Gemini client
-        genai.configure(api_key=api_key)
-        
-        # Create a simple wrapper class that provides the methods expected by the server
-        class GeminiClient:
-            def __init__(self):
-                pass
-                
-            def get_model(self, model_name):
-                """Create and return a GenerativeModel instance for the specified model."""
-                try:
-                    return genai.GenerativeModel(model_name)
-                except Exception as e:
-                    print(f"Error creating model {model_name}: {str(e)}")
-                    raise
-        
-        # Create and return the client wrapper
-        return GeminiClient()
+        # Reuse the key's service client (and its open channel) from an earlier request
+        with GEMINI_SERVICE_CLIENTS_LOCK:
+            service_client = GEMINI_SERVICE_CLIENTS.get(key_hash)
+            if service_client is not None:
+                GEMINI_SERVICE_CLIENTS.move_to_end(key_hash)
+        if service_client is None:
+            logger.info("Creating Google Gemini client with API key: %s...", api_key[:4])
+            service_client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+            with GEMINI_SERVICE_CLIENTS_LOCK:
+                GEMINI_SERVICE_CLIENTS[key_hash] = service_client
+                while len(GEMINI_SERVICE_CLIENTS) > GEMINI_CLIENT_CACHE_SIZE:
+                    GEMINI_SERVICE_CLIENTS.popitem(last=False)
+        return GeminiClient(service_client)
             
     except Exception as e:
-        print(f"Gemini client creation failed: {str(e)}")
+        logger.error("Gemini client creation failed: %s", e)
         raise Exception(f"Failed to create Google Gemini client: {str(e)}")
 
+def format_stream_event(event_type, data=None):
+    """Format a Server-Sent Event (SSE) message as bytes"""
+    if data:
+        return b"event: " + event_type.encode('ascii') + b"\ndata: " + json_bytes(data) + b"\n\n"
+    return b"event: " + event_type.encode('ascii') + b"\n\n"
+
+def parse_gemini_request(data, default_max_tokens, default_temperature):
+    """
+    Validate a Gemini generation request body in one pass.
+    Returns (params, None) on success, or (None, error_message) for a 400 response.
+    """
+    if not isinstance(data, dict):
+        return None, "Request body must be a JSON object"
+    
+    # Accept 'source' as a fallback for 'content' for compatibility
+    content = data.get('content') or data.get('source') or ''
+    if not content or not isinstance(content, str):
+        return None, "Source code or text is required"
+    
+    try:
+        max_tokens = int(data.get('max_tokens', default_max_tokens))
+        temperature = float(data.get('temperature', default_temperature))
+    except (TypeError, ValueError):
+        return None, "max_tokens and temperature must be numbers"
+    
+    return {
+        'api_key': data.get('api_key'),
+        'content': content,
+        'format_prompt': data.get('format_prompt') or '',
+        'max_tokens': max_tokens,
+        'temperature': temperature,
+        'session_id': data.get('session_id') or str(uuid.uuid4()),
+        'model': data.get('model')
+    }, None
+
+# Gemini models a request may name in its 'model' field. Pro is the default everywhere,
+# including Vercel. Flash answers small prompts far faster but with plainer pages, so it is
+# only used when a request asks for it, or for short content when GEMINI_FAST_MODEL=1.
+GEMINI_MODEL_PRO = "gemini-2.5-pro"
+GEMINI_MODEL_FAST = "gemini-2.5-flash"
+GEMINI_MODELS = (GEMINI_MODEL_PRO, GEMINI_MODEL_FAST)
+GEMINI_FAST_MODEL_ENABLED = os.environ.get('GEMINI_FAST_MODEL') == '1'
+GEMINI_FAST_MODEL_MAX_CHARS = 4000
+
+def select_gemini_model(requested, content, default_model=GEMINI_MODEL_PRO):
+    """Pick the model for a request: an allowed explicit choice, else Flash if opted in and short, else the default."""
+    if requested in GEMINI_MODELS:
+        return requested
+    if GEMINI_FAST_MODEL_ENABLED and len(content) < GEMINI_FAST_MODEL_MAX_CHARS:
+        return GEMINI_MODEL_FAST
+    return default_model
+
+def estimate_tokens(text):
+    """
+    Rough token count for text when the API reports no usage (about 4 characters per token).
+    Uses only the string length, so no word list is built over large prompts or outputs.
+    """
+    return max(1, len(text) >> 2)
+
+def truncate_to_token_budget(text, budget):
+    """
+    Cut text to roughly `budget` tokens, counting ASCII at about 4 characters per token and
+    any other character (CJK, emoji, ...) as a whole token, so non-Latin content cannot
+    overshoot the budget the way a plain character limit lets it.
+    The common cases (short text, pure ASCII) need no per-character scan; text within the
+    budget is returned as-is, without a copy.
+    """
+    if len(text) <= budget:
+        return text  # within budget even at one token per character
+    if text.isascii():
+        limit = budget * 4
+        return text if len(text) <= limit else text[:limit]
+    # Mixed text: spend the budget in quarter tokens until it runs out
+    remaining = budget * 4
+    for index, char in enumerate(text):
+        remaining -= 1 if char < '\x80' else 4
+        if remaining < 0:
+            return text[:index]
+    return text
+
+def gemini_generation_config(base_config, max_tokens, temperature):
+    """
+    Return the generation config for a request. The module-level base config (built once
+    at import) is reused as-is when the request keeps its max_tokens and temperature.
+    Callers must treat the result as read-only.
+    """
+    if base_config["max_output_tokens"] == max_tokens and base_config["temperature"] == temperature:
+        return base_config
+    return dict(base_config, max_output_tokens=max_tokens, temperature=temperature)
+
+# Content-addressed cache of generated pages: an identical request (same API key, model,
+# parameters, content and format prompt) is answered from memory instead of a new 10-30s
+# generation. Keys always start with the caller's API key hash, so one user's pages are
+# never served to another caller (or to a revoked key) without a call under their own key.
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '256'))
+RESPONSE_CACHE_TTL = 3600  # seconds
+RESPONSE_CACHE = collections.OrderedDict()  # key -> (html, stored_at), oldest first
+RESPONSE_CACHE_LOCK = threading.Lock()
+
+def response_cache_key(*parts):
+    """SHA-256 over the request fields that determine the generated page (API key hash first)."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b"\0")  # separator, so ("ab", "c") and ("a", "bc") differ
+    return digest.hexdigest()
+
+# Optional shared tier for the response cache. Serverless instances do not share memory,
+# so when REDIS_URL is set (and the redis package is installed) pages are also kept in Redis.
+REDIS_URL = os.environ.get('REDIS_URL')
+RESPONSE_CACHE_REDIS = None
+RESPONSE_CACHE_REDIS_PREFIX = "gemini:page:"
+if REDIS_URL:
+    try:
+        import redis
+        RESPONSE_CACHE_REDIS = redis.Redis.from_url(REDIS_URL, socket_timeout=1, socket_connect_timeout=1)
+    except ImportError:
+        logger.warning("REDIS_URL is set but the redis package is not installed; caching in memory only")
+
+def get_cached_response(key):
+    """Return the cached page for key, or None if missing or older than RESPONSE_CACHE_TTL."""
+    with RESPONSE_CACHE_LOCK:
+        entry = RESPONSE_CACHE.get(key)
+        if entry is not None:
+            html, stored_at = entry
+            if time.monotonic() - stored_at <= RESPONSE_CACHE_TTL:
+                RESPONSE_CACHE.move_to_end(key)
+                return html
+            del RESPONSE_CACHE[key]
+    if RESPONSE_CACHE_REDIS is None:
+        return None
+    # Local miss: another instance may have generated the page
+    try:
+        stored = RESPONSE_CACHE_REDIS.get(RESPONSE_CACHE_REDIS_PREFIX + key)
+    except Exception as e:
+        logger.error("Response cache lookup in Redis failed: %s", e)
+        return None
+    if stored is None:
+        return None
+    html = stored.decode('utf-8')
+    cache_response(key, html, shared=False)
+    return html
+
+def cache_response(key, html, shared=True):
+    """Store a successfully generated page, evicting the least recently used entries."""
+    with RESPONSE_CACHE_LOCK:
+        RESPONSE_CACHE[key] = (html, time.monotonic())
+        RESPONSE_CACHE.move_to_end(key)
+        while len(RESPONSE_CACHE) > RESPONSE_CACHE_SIZE:
+            RESPONSE_CACHE.popitem(last=False)
+    if shared and RESPONSE_CACHE_REDIS is not None:
+        try:
+            RESPONSE_CACHE_REDIS.setex(RESPONSE_CACHE_REDIS_PREFIX + key, RESPONSE_CACHE_TTL, html)
+        except Exception as e:
+            logger.error("Response cache store in Redis failed: %s", e)
+
+# Semantic cache: near-duplicate submissions (re-uploads, reformatting) are matched by the
+# cosine similarity of their content embeddings. Off unless GEMINI_SEMANTIC_CACHE=1, since
+# every miss costs an extra embedding call and a hit returns a page generated for other text.
+# Entries are scoped to the caller's API key, parameters and exact format prompt (the bucket).
+# Within a bucket a page is only reused when the content has the same length (within
+# SEMANTIC_CACHE_LENGTH_TOLERANCE) and the same "facts": the exact sequence of numbers and
+# capitalized words. Editing a figure, date or name therefore never returns the old page,
+# however close the embeddings are.
+SEMANTIC_CACHE_ENABLED = os.environ.get('GEMINI_SEMANTIC_CACHE') == '1'
+SEMANTIC_CACHE_MODEL = "models/text-embedding-004"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get('GEMINI_SEMANTIC_CACHE_THRESHOLD', '0.92'))
+SEMANTIC_CACHE_LENGTH_TOLERANCE = 0.02
+SEMANTIC_FACT_PATTERN = re.compile(r"\d+(?:[.,:/-]\d+)*|\b[A-Z][\w'-]*")
+
+def content_fingerprint(content):
+    """Hash of the numbers and capitalized words of content, in order."""
+    return response_cache_key(*SEMANTIC_FACT_PATTERN.findall(content))
+
+class SemanticResponseCache:
+    """Generated pages indexed by L2-normalized content embeddings.
+
+    Entries are grouped by a bucket key (API key hash, model, parameters, format prompt), so
+    only content is compared. A cached page is a candidate only if its content had the same
+    fingerprint and about the same length; among candidates the most similar embedding wins
+    if it clears the threshold. Each bucket keeps its newest max_entries pages.
+    """
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD, max_entries=RESPONSE_CACHE_SIZE):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.buckets = {}  # bucket -> {'vectors', 'pages', 'fingerprints', 'lengths', 'matrix'}
+
+    def embed(self, api_key, text):
+        """Return the normalized embedding of text, or None if it could not be computed."""
+        if not GEMINI_AVAILABLE:
+            return None
+        try:
+            client = create_gemini_client(api_key)
+            result = genai.embed_content(model=SEMANTIC_CACHE_MODEL, content=text,
+                                         task_type="semantic_similarity",
+                                         client=client.service_client)
+            vector = result['embedding']
+        except Exception as e:
+            logger.error("Semantic cache embedding failed: %s", e)
+            return None
+        if NUMPY_AVAILABLE:
+            vector = np.asarray(vector, dtype=np.float32)
+            norm = float(np.linalg.norm(vector))
+        else:
+            norm = sum(x * x for x in vector) ** 0.5
+        if not norm:
+            return None
+        return vector / norm if NUMPY_AVAILABLE else [x / norm for x in vector]
+
+    def lookup(self, bucket, vector, content):
+        """Return the cached page for near-duplicate content, or None."""
+        fingerprint = content_fingerprint(content)
+        tolerance = len(content) * SEMANTIC_CACHE_LENGTH_TOLERANCE
+        with self.lock:
+            entry = self.buckets.get(bucket)
+            if not entry:
+                return None
+            candidates = [index for index, (cached_fingerprint, cached_length)
+                          in enumerate(zip(entry['fingerprints'], entry['lengths']))
+                          if cached_fingerprint == fingerprint and abs(cached_length - len(content)) <= tolerance]
+            if not candidates:
+                return None
+            if NUMPY_AVAILABLE:
+                # Stack the vectors once per change; a lookup is then one matrix-vector product
+                if entry['matrix'] is None:
+                    entry['matrix'] = np.vstack(entry['vectors'])
+                scores = entry['matrix'][candidates] @ vector
+                best = int(scores.argmax())
+                score = float(scores[best])
+            else:
+                scores = [sum(a * b for a, b in zip(entry['vectors'][index], vector)) for index in candidates]
+                best = max(range(len(scores)), key=scores.__getitem__)
+                score = scores[best]
+            if score < self.threshold:
+                return None
+            logger.info("Semantic cache hit with similarity %.3f", score)
+            return entry['pages'][candidates[best]]
+
+    def add(self, bucket, vector, content, html):
+        with self.lock:
+            entry = self.buckets.setdefault(bucket, {'vectors': [], 'pages': [], 'fingerprints': [],
+                                                     'lengths': [], 'matrix': None})
+            entry['vectors'].append(vector)
+            entry['pages'].append(html)
+            entry['fingerprints'].append(content_fingerprint(content))
+            entry['lengths'].append(len(content))
+            if len(entry['vectors']) > self.max_entries:
+                for field in ('vectors', 'pages', 'fingerprints', 'lengths'):
+                    del entry[field][0]
+            entry['matrix'] = None
+
+SEMANTIC_CACHE = SemanticResponseCache()
+
+def extract_gemini_text(response):
+    """
+    Return the text of a Gemini response (or stream chunk) in one pass.
+    Joins the text parts of the first candidate, which is where the SDK's response.text
+    reads from; objects without candidates fall back to their text attribute.
+    """
+    candidates = getattr(response, 'candidates', None)
+    if candidates:
+        content = getattr(candidates[0], 'content', None)
+        return "".join(part.text for part in getattr(content, 'parts', None) or () if getattr(part, 'text', None))
+    try:
+        return getattr(response, 'text', None) or ""
+    except ValueError:
+        # The SDK raises ValueError from .text when the response has no text parts
+        return ""
+
+def gemini_usage_tokens(usage_metadata):
+    """
+    Read exact token counts from a Gemini response's usage_metadata.
+    Returns (input_tokens, output_tokens, cached_tokens), or None when the metadata is missing.
+    """
+    if not usage_metadata:
+        return None
+    input_tokens = getattr(usage_metadata, 'prompt_token_count', 0) or 0
+    output_tokens = getattr(usage_metadata, 'candidates_token_count', 0) or 0
+    if not input_tokens and not output_tokens:
+        return None
+    cached_tokens = getattr(usage_metadata, 'cached_content_token_count', 0) or 0
+    return input_tokens, output_tokens, cached_tokens
+
+# SSE comment line used as a heartbeat; EventSource and the frontend parser skip it
+SSE_PING = b": ping\n\n"
+
+# Empty tick a stream yields while its source is quiet; coalesce_sse uses it to send
+# buffered deltas on time and writes nothing for it otherwise
+SSE_FLUSH = b""
+
+# Fixed framing of the stream_start event; only the session id varies
+STREAM_START_PREFIX = b'event: stream_start\ndata: {"message": "Stream starting", "session_id": '
+
+def stream_start_event(session_id):
+    """Return the encoded stream_start event for a session without building a payload dict."""
+    return STREAM_START_PREFIX + json_bytes(session_id) + b'}\n\n'
+
+class SSEEncoder:
+    """
+    Builds content_block_delta SSE frames for a single stream as bytes.
+    The framing and the chunk id prefix never change during a stream, so they are
+    encoded once here and only the chunk text is serialized for each delta.
+    The session id is not repeated per delta; clients get it from stream_start
+    (and the X-Session-Id header).
+    """
+    DELTA_PREFIX = b'event: content\ndata: {"type": "content_block_delta", "delta": {"text": '
+    DELTA_SUFFIX = b'}\n\n'
+    THINKING_PREFIX = b'event: content\ndata: {"type": "thinking_update", "chunk_id": '
+
+    def __init__(self, message_id):
+        self.chunk_id_prefix = json.dumps(f"{message_id}_")[:-1].encode('utf-8')
+
+    def content_delta(self, text, chunk_count, segment=None, partial=False):
+        """Return the encoded content_block_delta frame for one chunk of text."""
+        counters = b'%d", "chunk_count": %d' % (chunk_count, chunk_count)
+        if segment is not None:
+            counters += b', "segment": %d' % segment
+        if partial:
+            counters += b', "partial": true'
+        return b"".join((
+            self.DELTA_PREFIX,
+            json_bytes(text),
+            b'}, "chunk_id": ',
+            self.chunk_id_prefix,
+            counters,
+            self.DELTA_SUFFIX
+        ))
+
+    def thinking_update(self, content, chunk_count):
+        """Return the encoded thinking_update frame; the chunk id is the cached prefix plus the counter."""
+        return b"".join((
+            self.THINKING_PREFIX,
+            self.chunk_id_prefix,
+            b'%d", "thinking": {"content": ' % chunk_count,
+            json_bytes(content),
+            b'}}\n\n'
+        ))
+
+# Leading bytes of a message_complete frame (stdlib json and orjson spacing)
+COMPLETE_PREFIXES = (
+    b'event: content\ndata: {"type": "message_complete"',
+    b'event: content\ndata: {"type":"message_complete"',
+)
+
+def coalesce_sse(events, max_bytes=4096, max_delay=0.1):
+    """
+    Merge consecutive content deltas from an SSE generator into fewer, larger writes.
+    Under WSGI every yielded item is its own socket write and flush, so deltas are held
+    until max_bytes are buffered or max_delay seconds have passed; any other event
+    flushes the buffer first, and a ping flushes waiting content in place of itself.
+    The delay is only checked when an event arrives, so it is a hard bound only for
+    generators that yield SSE_FLUSH ticks (at least every max_delay) while upstream is
+    quiet; for the others buffered text waits for the next event and is best-effort.
+    A message_complete frame is held for the event that follows it (normally stream_end),
+    so the two go out in one write.
+    """
+    pending = []
+    pending_size = 0
+    last_flush = time.monotonic()
+    try:
+        for event in events:
+            if isinstance(event, str):
+                event = event.encode('utf-8')
+            
+            if not event:
+                # SSE_FLUSH tick: send content that has waited long enough, else write nothing
+                if pending and time.monotonic() - last_flush >= max_delay:
+                    yield b"".join(pending)
+                    pending = []
+                    pending_size = 0
+                    last_flush = time.monotonic()
+                continue
+            
+            if event.startswith(SSEEncoder.DELTA_PREFIX):
+                pending.append(event)
+                pending_size += len(event)
+                if pending_size >= max_bytes or time.monotonic() - last_flush >= max_delay:
+                    yield b"".join(pending)
+                    pending = []
+                    pending_size = 0
+                    last_flush = time.monotonic()
+                continue
+            
+            if event == SSE_PING and pending:
+                # Send the buffered content instead of the ping; it keeps the connection
+                # alive just as well and does not sit in the buffer while upstream is quiet
+                yield b"".join(pending)
+                pending = []
+                pending_size = 0
+                last_flush = time.monotonic()
+                continue
+            
+            if event.startswith(COMPLETE_PREFIXES):
+                # Send together with whatever comes next (or at the end of the stream)
+                pending.append(event)
+                pending_size += len(event)
+                continue
+            
+            if pending:
+                pending.append(event)
+                event = b"".join(pending)
+                pending = []
+                pending_size = 0
+            last_flush = time.monotonic()
+            yield event
+        
+        if pending:
+            yield b"".join(pending)
+    finally:
+        # Close the wrapped generator right away when the client disconnects
+        close_events = getattr(events, 'close', None)
+        if close_events:
+            close_events()
+
+def iter_with_heartbeat(iterable, interval=10.0, max_pending=16):
+    """
+    Iterate a blocking iterable (e.g. a Gemini response stream) on a background thread.
+    Yields its items as they arrive, and None whenever nothing has arrived for interval
+    seconds, so the caller can write a keepalive while the model is buffering a large chunk.
+    Exceptions raised by the iterable are re-raised in the caller's thread.
+    At most max_pending items are buffered; when the caller stops early (client disconnect,
+    generator closed) the producer stops reading and the iterable is closed if it can be.
+    """
+    items = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+    done = object()
+    
+    def put(entry):
+        # Block while the consumer is behind, but give up once it has gone away
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set() or not put((item, None)):
+                    return
+        except Exception as e:
+            put((None, e))
+        finally:
+            put((done, None))
+    
+    threading.Thread(target=produce, daemon=True).start()
+    
+    try:
+        while True:
+            try:
+                item, error = items.get(timeout=interval)
+            except queue.Empty:
+                yield None
+                continue
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        close = getattr(iterable, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except Exception as e:
+                logger.error("Error closing stream: %s", e)
+
+def get_gemini_model(api_key, model_name, system_instruction=None):
+    """
+    Return a GenerativeModel bound to the API key's own (cached) service client.
+    Building the model object is cheap; the client behind it is reused across requests.
+    The optional system_instruction is bound to the model, so prompts only carry user content.
+    """
+    client = create_gemini_client(api_key)
+    return client.get_model(model_name, system_instruction=system_instruction)
+
+def forget_gemini_models_on_auth_error(error, api_key=None):
+    """
+    Drop the cached service client of api_key (all clients if no key is given) when a
+    Gemini call fails authentication (401/403), so a revoked or mistyped key does not
+    keep being served from the cache. Returns True if anything was dropped.
+    """
+    if getattr(error, 'code', None) in (401, 403) or 'API_KEY_INVALID' in str(error):
+        with GEMINI_SERVICE_CLIENTS_LOCK:
+            if api_key:
+                GEMINI_SERVICE_CLIENTS.pop(gemini_key_hash(api_key), None)
+            else:
+                GEMINI_SERVICE_CLIENTS.clear()
+        logger.warning("Gemini authentication failed; dropped the cached client")
+        return True
+    return False
+
+# Base URL of the Gemini REST API used by GeminiSSEStream
+GEMINI_API_BASE = os.environ.get('GEMINI_API_BASE', 'https://generativelanguage.googleapis.com/v1beta')
+
+# SDK-style safety setting names mapped to REST harm categories
+GEMINI_HARM_CATEGORIES = {
+    "harassment": "HARM_CATEGORY_HARASSMENT",
+    "hate_speech": "HARM_CATEGORY_HATE_SPEECH",
+    "sexual": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+    "dangerous": "HARM_CATEGORY_DANGEROUS_CONTENT",
+}
+
+class GeminiAPIError(Exception):
+    """Non-200 reply from the Gemini REST API; code is the HTTP status, as on google.api_core errors."""
+    def __init__(self, code, error_text):
+        super().__init__(f"Gemini API returned status {code}: {error_text}")
+        self.code = code
+
+class GeminiSSEStream:
+    """
+    Streams text from Gemini's REST streamGenerateContent endpoint (alt=sse).
+    Iterating yields each event's text as a plain string, reading only the parts
+    text and usage metadata instead of building the SDK's response objects per chunk.
+    """
+    def __init__(self, api_key, model_name, prompt, generation_config=None, safety_settings=None,
+                 system_instruction=None, timeout=600):
+        self.usage_metadata = None  # Set from the last event that reports usageMetadata
+        
+        payload = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+        if system_instruction:
+            # Sent in Gemini's system slot rather than prepended to the user prompt
+            payload["systemInstruction"] = {"parts": [{"text": system_instruction}]}
+        if generation_config:
+            rest_names = {"max_output_tokens": "maxOutputTokens", "temperature": "temperature",
+                          "top_p": "topP", "top_k": "topK"}
+            payload["generationConfig"] = {
+                rest_names[name]: value for name, value in generation_config.items()
+                if name in rest_names and value is not None
+            }
+        if safety_settings:
+            payload["safetySettings"] = [
+                {"category": GEMINI_HARM_CATEGORIES.get(name, name), "threshold": threshold.upper()}
+                for name, threshold in safety_settings.items()
+            ]
+        
+        self.response = HTTP_SESSION.post(
+            f"{GEMINI_API_BASE}/models/{model_name}:streamGenerateContent",
+            params={"alt": "sse"},
+            headers={"x-goog-api-key": api_key, "content-type": "application/json"},
+            json=payload,
+            stream=True,
+            timeout=timeout
+        )
+        if self.response.status_code != 200:
+            error_text = self.response.text[:500]
+            self.response.close()
+            raise GeminiAPIError(self.response.status_code, error_text)
+    
+    def close(self):
+        """Close the upstream HTTP response, ending generation on Gemini's side."""
+        self.response.close()
+    
+    def __iter__(self):
+        try:
+            # chunk_size=None hands over data as it arrives instead of waiting for a full block
+            for line in self.response.iter_lines(chunk_size=None):
+                if not line.startswith(b"data: "):
+                    continue
+                event = json_loads(line[6:])
+                
+                usage = event.get("usageMetadata")
+                if usage:
+                    self.usage_metadata = types.SimpleNamespace(
+                        prompt_token_count=usage.get("promptTokenCount", 0),
+                        candidates_token_count=usage.get("candidatesTokenCount", 0),
+                        cached_content_token_count=usage.get("cachedContentTokenCount", 0)
+                    )
+                
+                candidates = event.get("candidates")
+                if not candidates:
+                    yield ""
+                    continue
+                parts = candidates[0].get("content", {}).get("parts") or ()
+                yield "".join(part.get("text", "") for part in parts)
+        finally:
+            self.response.close()
+
 class GeminiStreamingResponse:
     """
     Custom class to handle streaming responses from Google Gemini API.
     Provides compatibility with the server-sent events format used by the frontend.
     """
     def __init__(self, stream_response, session_id):
-        self.stream_response = stream_response
+        self.source = stream_response
+        self.stream_response = iter(stream_response)
         self.session_id = session_id
         self.text_chunks = []
         self.message_id = str(uuid.uuid4())
+        self.encoder = SSEEncoder(self.message_id)
         self.chunk_count = 0
-        self.accumulated_text = ""
-        self.start_time = time.time()
-        self.last_progress_time = time.time()
+        self.usage_metadata = None  # Exact token counts, reported on the final chunk
+        self.accumulated_length = 0  # Running length of text_chunks, joined only on completion
+        # Timeouts are measured on the monotonic clock, which is cheaper than time.time() and
+        # unaffected by wall-clock adjustments
+        self.start_time = time.monotonic()
+        self.last_progress_time = self.start_time
         self.timeout = 300  # Maximum time to wait for first chunk (seconds)
         self.progress_timeout = 100  # Maximum time to wait between chunks (seconds)
         self.response_complete = False
+        self.finished = False  # Set once the final event has been returned
+        # Small Gemini deltas are coalesced into one SSE event until either limit is reached
+        self.pending_chunks = []
+        self.pending_length = 0
+        self.flush_size = 256  # Characters buffered before a delta is sent
+        self.flush_interval = 0.025  # Maximum time text is held back (seconds)
+        self.last_flush_time = time.monotonic()
         
     def __enter__(self):
         return self
         
     def __exit__(self, exc_type, exc_val, exc_tb):
+        # Always release the upstream stream. When the client disconnects, the WSGI server
+        # closes the response generator, which raises GeneratorExit inside this block;
+        # closing here stops pulling tokens from Gemini nobody will read.
+        self.close()
+        
         # If an exception occurred, we need to handle it
         if exc_type is not None:
-            print(f"Exception in GeminiStreamingResponse: {exc_type} - {exc_val}")
+            logger.error("Exception in GeminiStreamingResponse: %s - %s", exc_type, exc_val)
             # If we have accumulated some text, generate a partial response
-            if self.accumulated_text:
-                print(f"Returning partial accumulated content ({len(self.accumulated_text)} chars)")
+            if self.accumulated_length:
+                logger.warning("Returning partial accumulated content (%s chars)", self.accumulated_length)
                 return False  # Don't suppress the exception
         
         # If response didn't complete but we have content, mark as complete
-        if not self.response_complete and self.accumulated_text:
+        if not self.response_complete and self.accumulated_length:
             self.response_complete = True
             message = "Stream completed with partial content"
-            print(message)
+            logger.info(message)
         
         return False  # Don't suppress exceptions
     
     def __iter__(self):
         return self
     
+    def close(self):
+        """Stop the stream and close the upstream Gemini response if it supports closing."""
+        self.finished = True
+        close_source = getattr(self.source, 'close', None)
+        if close_source:
+            try:
+                close_source()
+            except Exception as e:
+                logger.error("Error closing Gemini stream: %s", e)
+    
+    def _flush_pending(self):
+        """Return one content delta event for all buffered chunk text and reset the buffer."""
+        text = "".join(self.pending_chunks)
+        self.pending_chunks = []
+        self.pending_length = 0
+        self.last_flush_time = time.monotonic()
+        return self.encoder.content_delta(text, self.chunk_count)
+    
     def __next__(self):
         """
         Process the next chunk from the Gemini stream and yield formatted SSE events.
         Handles timeouts and converts Gemini response format to the expected SSE format.
         """
+        if self.finished:
+            raise StopIteration
+        
         # Check for initial timeout (no chunks received yet)
-        if not self.text_chunks and time.time() - self.start_time > self.timeout:
-            print(f"Timeout waiting for first chunk ({self.timeout}s)")
+        now = time.monotonic()
+        if not self.text_chunks and now - self.start_time > self.timeout:
+            logger.warning("Timeout waiting for first chunk (%ss)", self.timeout)
             # Yield a timeout error event
             event_data = {
                 "type": "error",
-                "error": f"Timeout waiting for response from Gemini API after {self.timeout} seconds.",
-                "session_id": self.session_id
+                "error": f"Timeout waiting for response from Gemini API after {self.timeout} seconds."
             }
             return format_stream_event("error", event_data)
         
         # Check for progress timeout (no new chunks recently)
-        if self.text_chunks and time.time() - self.last_progress_time > self.progress_timeout:
-            print(f"Timeout waiting for next chunk ({self.progress_timeout}s)")
+        if self.text_chunks and now - self.last_progress_time > self.progress_timeout:
+            logger.warning("Timeout waiting for next chunk (%ss)", self.progress_timeout)
             # If we have accumulated some content, mark the response as complete to return what we have
-            if self.accumulated_text:
+            if self.accumulated_length:
                 self.response_complete = True
                 event_data = {
                     "type": "status",
-                    "message": "Timeout waiting for additional content from Gemini API. Returning partial response.",
-                    "session_id": self.session_id
+                    "message": "Timeout waiting for additional content from Gemini API. Returning partial response."
                 }
                 return format_stream_event("status", event_data)
             else:
                 # No content received at all, return an error
                 event_data = {
                     "type": "error",
-                    "error": f"No content received from Gemini API after {self.progress_timeout} seconds.",
-                    "session_id": self.session_id
+                    "error": f"No content received from Gemini API after {self.progress_timeout} seconds."
                 }
                 return format_stream_event("error", event_data)
         
         try:
-            # Get next chunk from stream
-            chunk = next(self.stream_response)
-            self.last_progress_time = time.time()
-            self.chunk_count += 1
-            
-            # Extract text content from the chunk
-            chunk_text = ""
-            if hasattr(chunk, 'text'):
-                chunk_text = chunk.text
-            elif hasattr(chunk, 'parts') and chunk.parts:
-                for part in chunk.parts:
-                    if hasattr(part, 'text') and part.text:
-                        chunk_text += part.text
-            
-            # Skip empty chunks
-            if not chunk_text:
-                if self.chunk_count % 10 == 0:
-                    # Periodically send keepalive events
-                    event_data = {
-                        "type": "keepalive",
-                        "timestamp": time.time(),
-                        "session_id": self.session_id,
-                        "chunk_count": self.chunk_count
-                    }
-                    return format_stream_event("keepalive", event_data)
-                return self.__next__()  # Skip to next chunk
-            
-            # Store the chunk
-            self.text_chunks.append(chunk_text)
-            self.accumulated_text += chunk_text
-            
-            # Create content delta event
-            event_data = {
-                "type": "content_block_delta",
-                "chunk_id": f"{self.message_id}_{self.chunk_count}",
-                "delta": {
-                    "text": chunk_text
-                },
-                "session_id": self.session_id,
-                "chunk_count": self.chunk_count
-            }
+            while True:
+                # Get next chunk from stream
+                chunk = next(self.stream_response)
+                # Read the clock once per chunk and reuse it for the progress and flush checks
+                now = time.monotonic()
+                self.last_progress_time = now
+                self.chunk_count += 1
+                if getattr(chunk, 'usage_metadata', None):
+                    self.usage_metadata = chunk.usage_metadata
+                
+                # Extract text content from the chunk (GeminiSSEStream yields plain strings)
+                chunk_text = chunk if isinstance(chunk, str) else extract_gemini_text(chunk)
+                
+                # Skip empty chunks
+                if not chunk_text:
+                    if self.chunk_count % 10 == 0:
+                        # Periodically send a keepalive as an SSE comment line, which
+                        # clients ignore and which needs no JSON encoding
+                        return SSE_PING
+                    continue  # Skip to next chunk
+                
+                # Store the chunk
+                self.text_chunks.append(chunk_text)
+                self.accumulated_length += len(chunk_text)
+                self.pending_chunks.append(chunk_text)
+                self.pending_length += len(chunk_text)
+                
+                # Every N chunks, send a keepalive event
+                if self.chunk_count % 5 == 0:
+                    logger.debug("Processed %s chunks from Gemini", self.chunk_count)
+                
+                # Send buffered text once enough has accumulated or it has been held long enough
+                if (self.pending_length >= self.flush_size or
+                        now - self.last_flush_time > self.flush_interval):
+                    # Create content delta event (pre-encoded bytes, see SSEEncoder)
+                    return self._flush_pending()
             
-            # Every N chunks, send a keepalive event
-            if self.chunk_count % 5 == 0:
-                print(f"Processed {self.chunk_count} chunks from Gemini")
+        except StopIteration:
+            # Send any buffered text first; the exhausted stream raises StopIteration again next call
+            if self.pending_chunks:
+                return self._flush_pending()
             
-            return format_stream_event("content", event_data)
+            self.finished = True
             
-        except StopIteration:
             # Check if we received any content
-            if not self.accumulated_text:
-                print("No content received from Gemini API before StopIteration")
+            if not self.accumulated_length:
+                logger.warning("No content received from Gemini API before StopIteration")
                 error_data = {
                     "type": "error",
-                    "error": "No content received from Gemini API. Please try again or check your API key.",
-                    "session_id": self.session_id
+                    "error": "No content received from Gemini API. Please try again or check your API key."
                 }
                 return format_stream_event("error", error_data)
             
             # Stream is complete, send completion event
-            print(f"Gemini stream complete, received {self.chunk_count} chunks")
+            logger.info("Gemini stream complete, received %s chunks", self.chunk_count)
             self.response_complete = True
             
-            # Calculate token usage (approximate)
-            input_prompt_length = 1000  # Placeholder
-            output_length = len(self.accumulated_text)
+            # Join the accumulated chunks once, now that the stream is complete
+            accumulated_text = "".join(self.text_chunks)
             
-            # Estimate token count (very rough estimate)
-            input_tokens = input_prompt_length // 4
-            output_tokens = output_length // 4
+            # Use the exact token counts reported by Gemini when available
+            if self.usage_metadata is None:
+                self.usage_metadata = getattr(self.source, 'usage_metadata', None)
+            usage_tokens = gemini_usage_tokens(self.usage_metadata)
+            if usage_tokens:
+                input_tokens, output_tokens, cached_tokens = usage_tokens
+            else:
+                # Estimate token count (very rough estimate)
+                input_prompt_length = 1000  # Placeholder
+                input_tokens = input_prompt_length // 4
+                output_tokens = self.accumulated_length // 4
+                cached_tokens = 0
+            
+            usage = {
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens,
+                "total_cost": 0.0  # Gemini API currently doesn't charge
+            }
+            if cached_tokens:
+                usage["cached_tokens"] = cached_tokens
             
             # Create completion event
             complete_data = {
                 "type": "message_complete",
                 "message_id": self.message_id,
                 "chunk_id": f"{self.message_id}_{self.chunk_count}",
-                "usage": {
-                    "input_tokens": input_tokens,
-                    "output_tokens": output_tokens,
-                    "total_tokens": input_tokens + output_tokens,
-                    "total_cost": 0.0  # Gemini API currently doesn't charge
-                },
-                "html": self.accumulated_text,
+                "usage": usage,
+                "html": accumulated_text,
                 "session_id": self.session_id,
                 "final_chunk_count": self.chunk_count
             }
@@ -255,12 +985,14 @@ class GeminiStreamingResponse:
         except Exception as e:
             # Log the error
             error_message = str(e)
-            print(f"Error processing Gemini stream chunk: {error_message}")
+            logger.error("Error processing Gemini stream chunk: %s", error_message)
+            
+            self.finished = True
             
             # If we have any accumulated content, we'll mark as complete to return what we have
-            if self.accumulated_text:
+            if self.accumulated_length:
                 self.response_complete = True
-                print(f"Returning partial accumulated content ({len(self.accumulated_text)} chars)")
+                logger.warning("Returning partial accumulated content (%s chars)", self.accumulated_length)
                 
                 # Send completion with partial content
                 complete_data = {
@@ -269,10 +1001,10 @@ class GeminiStreamingResponse:
                     "chunk_id": f"{self.message_id}_{self.chunk_count}",
                     "usage": {
                         "input_tokens": 1000,  # Placeholder estimate
-                        "output_tokens": len(self.accumulated_text) // 4,
-                        "total_tokens": 1000 + (len(self.accumulated_text) // 4)
+                        "output_tokens": self.accumulated_length // 4,
+                        "total_tokens": 1000 + (self.accumulated_length // 4)
                     },
-                    "html": self.accumulated_text,
+                    "html": "".join(self.text_chunks),
                     "session_id": self.session_id,
                     "final_chunk_count": self.chunk_count,
                     "partial": True,
@@ -284,8 +1016,7 @@ class GeminiStreamingResponse:
                 # No accumulated content, return error
                 error_data = {
                     "type": "error",
-                    "error": f"Error in Gemini streaming: {error_message}",
-                    "session_id": self.session_id
+                    "error": f"Error in Gemini streaming: {error_message}"
                 }
                 return format_stream_event("error", error_data)
 
@@ -310,7 +1041,7 @@ class VercelCompatibleClient:
         if headers:
             _headers.update(headers)
         
-        response = requests.post(
+        response = HTTP_SESSION.post(
             url,
             json=json,
             headers=_headers,
@@ -325,7 +1056,7 @@ class VercelCompatibleClient:
                 self.client = client
                 
             def list(self):
-                response = requests.get(
+                response = HTTP_SESSION.get(
                     f"{self.client.base_url}/models",
                     headers=self.client.headers
                 )
@@ -359,7 +1090,7 @@ class VercelCompatibleClient:
                 for Vercel environment. Uses a stateful approach that supports reconnection.
                 """
                 # Check if we're on Vercel - if so, we need to handle timeouts differently
-                is_vercel = os.environ.get('VERCEL', False)
+                is_vercel = IS_VERCEL
                 
                 # Generate a unique ID for this streaming session
                 session_id = str(int(time.time())) + "-" + str(hash(str(messages)))[1:8]
@@ -441,7 +1172,7 @@ class VercelCompatibleClient:
                 while retry_count < max_retries:
                     try:
                         # Make the API request to stream response
-                        stream_response = requests.post(
+                        stream_response = HTTP_SESSION.post(
                             f"{self.client.base_url}/messages",
                             headers=headers,
                             json=payload,
@@ -455,19 +1186,19 @@ class VercelCompatibleClient:
                             if stream_response.status_code == 529:  # Overloaded
                                 retry_count += 1
                                 retry_delay = base_delay * (2 ** retry_count)  # Exponential backoff
-                                print(f"API overloaded (529), retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
+                                logger.warning("API overloaded (529), retrying in %s seconds (attempt %s/%s)", retry_delay, retry_count, max_retries)
                                 time.sleep(retry_delay)
                                 continue
                             elif stream_response.status_code == 500:  # Internal server error
                                 retry_count += 1
                                 retry_delay = base_delay * (2 ** retry_count)  # Exponential backoff
-                                print(f"API internal error (500), retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
+                                logger.warning("API internal error (500), retrying in %s seconds (attempt %s/%s)", retry_delay, retry_count, max_retries)
                                 time.sleep(retry_delay)
                                 continue
                             elif stream_response.status_code == 408:  # Timeout
                                 retry_count += 1
                                 retry_delay = base_delay * (2 ** retry_count)  # Exponential backoff
-                                print(f"API timeout (408), retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
+                                logger.warning("API timeout (408), retrying in %s seconds (attempt %s/%s)", retry_delay, retry_count, max_retries)
                                 time.sleep(retry_delay)
                                 continue
                             
@@ -497,7 +1228,7 @@ class VercelCompatibleClient:
                             if retry_count >= max_retries:
                                 raise Exception(f"Vercel timeout after {max_retries} retries - client should continue with session: {session_id}")
                             retry_delay = base_delay * (2 ** retry_count)
-                            print(f"Vercel timeout, retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
+                            logger.warning("Vercel timeout, retrying in %s seconds (attempt %s/%s)", retry_delay, retry_count, max_retries)
                             time.sleep(retry_delay)
                             continue
                         else:
@@ -505,7 +1236,7 @@ class VercelCompatibleClient:
                             if retry_count >= max_retries:
                                 raise Exception(f"Request timed out after {max_retries} retries")
                             retry_delay = base_delay * (2 ** retry_count)
-                            print(f"Request timed out, retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
+                            logger.warning("Request timed out, retrying in %s seconds (attempt %s/%s)", retry_delay, retry_count, max_retries)
                             time.sleep(retry_delay)
                             continue
                             
@@ -516,7 +1247,7 @@ class VercelCompatibleClient:
                             if retry_count >= max_retries:
                                 raise Exception(f"Connection error after {max_retries} retries: {str(e)}")
                             retry_delay = base_delay * (2 ** retry_count)
-                            print(f"Connection error, retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
+                            logger.warning("Connection error, retrying in %s seconds (attempt %s/%s)", retry_delay, retry_count, max_retries)
                             time.sleep(retry_delay)
                             continue
                         else:
@@ -602,7 +1333,7 @@ class VercelCompatibleClient:
             while retry_count < max_retries:
                 try:
                     # Make the API request with a longer timeout for large requests
-                    response = requests.post(
+                    response = HTTP_SESSION.post(
                         f"{self.client.base_url}/messages",
                         headers=headers,
                         json=payload,
@@ -621,21 +1352,21 @@ class VercelCompatibleClient:
                     elif response.status_code == 529:  # Overloaded
                         retry_count += 1
                         retry_delay = base_delay * (2 ** retry_count)  # Exponential backoff
-                        print(f"API overloaded (529), retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
+                        logger.warning("API overloaded (529), retrying in %s seconds (attempt %s/%s)", retry_delay, retry_count, max_retries)
                         time.sleep(retry_delay)
                         continue
                         
                     elif response.status_code == 500:  # Internal server error
                         retry_count += 1
                         retry_delay = base_delay * (2 ** retry_count)  # Exponential backoff
-                        print(f"API internal error (500), retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
+                        logger.warning("API internal error (500), retrying in %s seconds (attempt %s/%s)", retry_delay, retry_count, max_retries)
                         time.sleep(retry_delay)
                         continue
                         
                     elif response.status_code == 408:  # Timeout
                         retry_count += 1
                         retry_delay = base_delay * (2 ** retry_count)  # Exponential backoff
-                        print(f"API timeout (408), retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
+                        logger.warning("API timeout (408), retrying in %s seconds (attempt %s/%s)", retry_delay, retry_count, max_retries)
                         time.sleep(retry_delay)
                         continue
                     
@@ -652,7 +1383,7 @@ class VercelCompatibleClient:
                 except requests.exceptions.Timeout:
                     retry_count += 1
                     retry_delay = base_delay * (2 ** retry_count)
-                    print(f"Request timed out, retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
+                    logger.warning("Request timed out, retrying in %s seconds (attempt %s/%s)", retry_delay, retry_count, max_retries)
                     time.sleep(retry_delay)
                     continue
                     
@@ -661,7 +1392,7 @@ class VercelCompatibleClient:
                     if "connection" in str(e).lower() or "timeout" in str(e).lower():
                         retry_count += 1
                         retry_delay = base_delay * (2 ** retry_count)
-                        print(f"Connection error, retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
+                        logger.warning("Connection error, retrying in %s seconds (attempt %s/%s)", retry_delay, retry_count, max_retries)
                         time.sleep(retry_delay)
                         continue
                     else:
@@ -677,6 +1408,7 @@ class VercelStreamingResponse:
         self.client = client
         self.is_vercel = is_vercel
         self.session_id = session_id or str(uuid.uuid4())
+        self.chunk_id_prefix = f"{self.session_id}_"  # Built once; each chunk only appends its counter
         self.chunk_count = 0
         self.buffer = []
         self.buffer_limit = 10  # Maximum number of chunks to buffer
@@ -716,7 +1448,7 @@ class VercelStreamingResponse:
                         )
                         
                         # Add metadata for reconnection
-                        delta_obj.chunk_id = f"{self.session_id}_{self.chunk_count}"
+                        delta_obj.chunk_id = self.chunk_id_prefix + str(self.chunk_count)
                         delta_obj.session_id = self.session_id
                         delta_obj.chunk_count = self.chunk_count
                         
@@ -738,7 +1470,7 @@ class VercelStreamingResponse:
                         )
                         
                         # Add metadata for reconnection
-                        thinking_obj.chunk_id = f"{self.session_id}_{self.chunk_count}"
+                        thinking_obj.chunk_id = self.chunk_id_prefix + str(self.chunk_count)
                         thinking_obj.session_id = self.session_id
                         thinking_obj.chunk_count = self.chunk_count
                         
@@ -747,7 +1479,7 @@ class VercelStreamingResponse:
                         
                 except Exception as e:
                     # Log any errors but continue
-                    print(f"Error processing chunk: {str(e)}")
+                    logger.error("Error processing chunk: %s", e)
                     self.last_error = str(e)
                     # Don't break the iteration - continue to next chunk
             
@@ -787,7 +1519,7 @@ class VercelStreamingResponse:
             
         except Exception as e:
             # If there's a terminal error, send an error message
-            print(f"Stream error: {str(e)}")
+            logger.error("Stream error: %s", e)
             error_obj = self._ErrorChunk(str(e))
             error_obj.session_id = self.session_id
             yield error_obj
@@ -1,11 +1,11 @@
 import threading
 
-from flask import Flask, request, jsonify, Response, stream_with_context, send_from_directory
+from flask import Flask, request, jsonify, Response, send_from_directory
 from flask_cors import CORS
-from helper_function import create_anthropic_client, create_gemini_client, GeminiStreamingResponse
+from helper_function import create_anthropic_client, create_gemini_client, GeminiStreamingResponse, GeminiSSEStream, parse_gemini_request, load_json_body, SSEEncoder, json_bytes, stream_start_event, coalesce_sse, estimate_tokens, gemini_generation_config, forget_gemini_models_on_auth_error, use_orjson_for_jsonify, truncate_to_token_budget, select_gemini_model, gemini_key_hash, GEMINI_CLIENT_CACHE_SIZE, response_cache_key, get_cached_response, cache_response, SEMANTIC_CACHE_ENABLED, SEMANTIC_CACHE
 import anthropic
-import json
 import os
+import collections
 import re
 import time
 import traceback
@@ -45,13 +45,29 @@ except ImportError:
     print("Google Generative AI package not available. Some features may be limited.")
 
 # Initialize Flask app
+# Logging goes through the logging module (lazy %-formatting, level-filtered);
+# LOG_LEVEL sets the threshold, and --debug lowers it when run directly
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
 app = Flask(__name__, static_folder='static')
 CORS(app)  # Enable CORS for all routes
+use_orjson_for_jsonify(app)  # jsonify() encodes with orjson when installed
 
 # Set higher request timeout limits for Flask server
 app.config['TIMEOUT'] = 1800  # 30 minutes timeout
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max content size
 
+# Compress large JSON/HTML responses (generated pages are 50-200KB and compress 5-10x).
+# SSE streams are not in the compressed mimetypes, so events are still sent as they are produced.
+try:
+    from flask_compress import Compress
+    app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+    app.config['COMPRESS_MIN_SIZE'] = 500
+    Compress(app)
+except ImportError:
+    print("flask-compress not installed; responses are sent uncompressed")
+
 #
 result_cache = {}
 
@@ -59,6 +75,11 @@ result_cache = {}
 session_cache = {}
 SESSION_CACHE_EXPIRY = 3600  # 1 hour cache expiry
 
+def session_generated_text(cached_data):
+    """Text generated so far for a cached session; a running stream only appends to generated_parts"""
+    parts = cached_data.get('generated_parts')
+    return "".join(parts) if parts is not None else cached_data.get('generated_text', '')
+
 # Claude 3.7 has a total context window of 200,000 tokens (input + output combined)
 # We'll use this constant when estimating token usage
 TOTAL_CONTEXT_WINDOW = 200000
@@ -80,8 +101,17 @@ OUTPUT_128K_BETA = "output-128k-2025-02-19"
 MAX_TOKENS = 4096
 STREAM_CHUNK_SIZE = 2  # Number of chunks to process before sending a keepalive
 MAX_SEGMENT_SIZE = 16384  # 16KB chunks for content segments
+PARTIAL_FLUSH_SIZE = 1024  # Unsent characters that trigger a partial delta
+PARTIAL_FLUSH_INTERVAL = 0.2  # Maximum seconds unsent text waits for a partial delta
 CHECKPOINT_INTERVAL = 2 * 60  # 2 minutes between checkpoints (reduced from 5)
 
+# Print full tracebacks for stream errors only when GEMINI_DEBUG=1; formatting them
+# walks the stack and blocks the generator on stdout, and they never go to the client
+GEMINI_DEBUG = os.environ.get('GEMINI_DEBUG') == '1'
+
+# Same for the Claude stream generator, controlled by STREAM_DEBUG=1
+STREAM_DEBUG = os.environ.get('STREAM_DEBUG') == '1'
+
 # Retry settings
 MAX_RETRIES = 10  # Increase from 8 to 10
 MIN_BACKOFF_DELAY = 1  # Start with 1 second delay (reduced from 2)
@@ -95,9 +125,75 @@ GEMINI_TEMPERATURE = 1.0
 GEMINI_TOP_P = 0.95
 GEMINI_TOP_K = 64
 
+# Default generation config, built once; see gemini_generation_config
+GEMINI_GENERATION_CONFIG = {
+    "max_output_tokens": GEMINI_MAX_OUTPUT_TOKENS,
+    "temperature": GEMINI_TEMPERATURE,
+    "top_p": GEMINI_TOP_P,
+    "top_k": GEMINI_TOP_K
+}
+
+# Maximum (estimated) tokens of user content sent to Gemini; about 100000 characters of ASCII
+GEMINI_CONTENT_TOKEN_BUDGET = int(os.environ.get('GEMINI_CONTENT_TOKEN_BUDGET', '25000'))
+
 # Same system instruction for both APIs
 SYSTEM_INSTRUCTION = """I will provide you with a file or a content, analyze its content, and transform it into a visually appealing and well-structured webpage.### Content Requirements* Maintain the core information from the original file while presenting it in a clearer and more visually engaging format.⠀Design Style* Follow a modern and minimalistic design inspired by Linear App.* Use a clear visual hierarchy to emphasize important content.* Adopt a professional and harmonious color scheme that is easy on the eyes for extended reading.⠀Technical Specifications* Use HTML5, TailwindCSS 3.0+ (via CDN), and necessary JavaScript.* Implement a fully functional dark/light mode toggle, defaulting to the system setting.* Ensure clean, well-structured code with appropriate comments for easy understanding and maintenance.⠀Responsive Design* The page must be fully responsive, adapting seamlessly to mobile, tablet, and desktop screens.* Optimize layout and typography for different screen sizes.* Ensure a smooth and intuitive touch experience on mobile devices.⠀Icons & Visual Elements* Use professional icon libraries like Font Awesome or Material Icons (via CDN).* Integrate illustrations or charts that best represent the content.* Avoid using emojis as primary icons.* Check if any icons cannot be loaded.⠀User Interaction & ExperienceEnhance the user experience with subtle micro-interactions:* Buttons should have slight enlargement and color transitions on hover.* Cards should feature soft shadows and border effects on hover.* Implement smooth scrolling effects throughout the page.* Content blocks should have an elegant fade-in animation on load.⠀Performance Optimization* Ensure fast page loading by avoiding large, unnecessary resources.* Use modern image formats (WebP) with proper compression.* Implement lazy loading for content-heavy pages.⠀Output Requirements* Deliver a fully functional standalone HTML file, including all necessary CSS and JavaScript.* Ensure the code meets W3C standards with no errors or warnings.* Maintain consistent design and functionality across different browsers.* Your output is only one HTML file, do not present any other notes on the HTML. Also, try your best to visualize the whole content.⠀Create the most effective and visually appealing webpage based on the uploaded file's content type (document, data, images, etc.)."""
 
+# Page shell used when Gemini returns plain text instead of HTML ({body} is the text)
+WRAPPED_HTML_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Generated Content</title>
+    <link href="https://cdn.jsdelivr.net/npm/tailwindcss@2.2.19/dist/tailwind.min.css" rel="stylesheet">
+</head>
+<body class="bg-gray-100 dark:bg-gray-900 text-gray-800 dark:text-gray-200">
+    <div class="container mx-auto p-4">
+        {body}
+    </div>
+    <script>
+        // Simple dark mode toggle
+        if (window.matchMedia && window.matchMedia('(prefers-color-scheme: dark)').matches) {{
+            document.documentElement.classList.add('dark');
+        }}
+    </script>
+</body>
+</html>
+"""
+
+# Error page stored as the result when a background Gemini generation fails
+GEMINI_ERROR_HTML_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Error Processing Content</title>
+    <link href="https://cdn.jsdelivr.net/npm/tailwindcss@2.2.19/dist/tailwind.min.css" rel="stylesheet">
+</head>
+<body class="bg-gray-100 dark:bg-gray-900 text-gray-800 dark:text-gray-200">
+    <div class="container mx-auto p-8 max-w-3xl">
+        <div class="bg-white dark:bg-gray-800 p-6 rounded-lg shadow-lg">
+            <h1 class="text-2xl font-bold text-red-600 mb-4">Error Processing Content</h1>
+            <p class="mb-4">There was an error processing your content with the Gemini API:</p>
+            <div class="bg-gray-100 dark:bg-gray-700 p-4 rounded overflow-auto mb-4">
+                <code class="text-sm">{error_message}</code>
+            </div>
+            <p class="mb-2">Possible solutions:</p>
+            <ul class="list-disc pl-5 mb-4">
+                <li>Try again with a smaller content size</li>
+                <li>Check your Gemini API key</li>
+                <li>Try with a different content format</li>
+                <li>Switch to the Claude API if available</li>
+            </ul>
+        </div>
+    </div>
+</body>
+</html>
+"""
+
 @app.route('/')
 def serve_index():
     """Serve the main index.html file with version information in headers."""
@@ -627,16 +723,22 @@ def analyze_tokens():
         return jsonify({"error": f"Error analyzing tokens: {str(e)}"}), 500
 
 # Define helper functions for streaming
+# SSE comment line used as a heartbeat; clients ignore it, so it needs no JSON payload
+SSE_PING = b": ping\n\n"
+
+# stream_start event for streams that carry no session id; it never changes, so it is encoded once
+STREAM_START_BYTES = b'event: stream_start\ndata: {"message": "Stream starting"}\n\n'
+
 def format_stream_event(event_type, data=None):
-    """Format a Server-Sent Event (SSE) message"""
-    buffer = f"event: {event_type}\n"
+    """Format a Server-Sent Event (SSE) message as bytes (JSON via orjson when available)"""
+    buffer = b"event: " + event_type.encode('ascii') + b"\n"
     if data:
         # For status events, expose dispatch-friendly format
         if event_type == "status":
-            buffer += f"data: {json.dumps(data)}\n"
+            buffer += b"data: " + json_bytes(data) + b"\n"
             # Add a special field to dispatch custom event on the client side
-            buffer += f"id: status_{int(time.time())}\n"
-            buffer += f"retry: 15000\n"  # Tell client to retry connection after 15 seconds if dropped
+            buffer += b"id: status_%d\n" % int(time.time())
+            buffer += b"retry: 15000\n"  # Tell client to retry connection after 15 seconds if dropped
         
         # For error events, add enough info for the client to handle it
         elif event_type == "error":
@@ -653,15 +755,20 @@ def format_stream_event(event_type, data=None):
                 except Exception:
                     pass  # Ignore any errors in code extraction
             
-            buffer += f"data: {json.dumps(data)}\n"
+            buffer += b"data: " + json_bytes(data) + b"\n"
             # Add a special field to dispatch custom event
-            buffer += f"id: error_{int(time.time())}\n"
+            buffer += b"id: error_%d\n" % int(time.time())
         else:
             # Regular event
-            buffer += f"data: {json.dumps(data)}\n"
-    buffer += "\n"
+            buffer += b"data: " + json_bytes(data) + b"\n"
+    buffer += b"\n"
     return buffer
 
+def format_complete_event(complete_data, html):
+    """Format a message_complete SSE event as bytes, serializing the large html field on its own with json_bytes"""
+    payload = json_bytes(complete_data)
+    return b"".join((b"event: content\ndata: ", payload[:-1], b', "html": ', json_bytes(html), b"}\n\n"))
+
 def create_stream_generator(client, system_prompt, user_message, model, max_tokens, temperature, thinking_budget=None):
     """Create a generator that yields SSE events for streaming Claude responses"""
     try:
@@ -700,7 +807,7 @@ def create_stream_generator(client, system_prompt, user_message, model, max_toke
                 }
         
         # Start the streaming response
-        yield format_stream_event("stream_start", {"message": "Stream starting"})
+        yield STREAM_START_BYTES
         
         # Create streaming API call
         with client.messages.stream(**message_params) as stream:
@@ -875,14 +982,14 @@ def process_stream():
             "error": f"API key validation failed: {str(e)}"
         })
     
-    # Initialize session cache for this request
+    # Initialize session cache for this request (the slice copies, so only truncate long content)
     session_cache[session_id] = {
         'created_at': time.time(),
         'last_updated': time.time(),
         'html_segments': [],
         'generated_text': '',
         'chunk_count': 0,
-        'user_content': content[:100000],  # Store for potential reconnection
+        'user_content': content[:100000] if len(content) > 100000 else content,  # Store for potential reconnection
         'format_prompt': format_prompt,
         'model': model,
         'max_tokens': max_tokens,
@@ -901,19 +1008,23 @@ def process_stream():
         system_prompt += "\nEXTREMELY LARGE CONTENT DETECTED: Break the content into multiple pages and implement a navigation system. Do not use complex or heavy JavaScript frameworks. Keep CSS minimal and efficient."
     
     # Prepare user prompt - limit content size to avoid timeouts
-    content_limit = min(len(content), 100000)  # Limit to 100k characters
+    content_limit = 100000  # Limit to 100k characters
+    if len(content) > content_limit:
+        # Only slice when truncation is needed - slicing always copies the string
+        print(f"Truncating content from {len(content)} to {content_limit} characters")
+        content = content[:content_limit]
     user_content = f"""
     {format_prompt}
     
     Here is the content to transform into a website:
     
-    {content[:content_limit]}
+    {content}
     """
     
     # Define a streaming response generator with specific Claude 3.7 implementation
     def stream_generator():
         try:
-            yield format_stream_event("stream_start", {"message": "Stream starting", "session_id": session_id})
+            yield stream_start_event(session_id)
             
             # Add retry logic with exponential backoff
             max_retries = MAX_RETRIES
@@ -946,7 +1057,13 @@ def process_stream():
                         betas=[OUTPUT_128K_BETA],  # Using betas parameter instead of headers
                     ) as stream:
                         message_id = str(uuid.uuid4())
-                        generated_text = ""
+                        # Delta frames for this stream are pre-encoded; only the text is serialized per event
+                        encoder = SSEEncoder(message_id)
+                        # Generated text is collected as parts and joined once, instead of growing
+                        # one string per chunk; the cache shares the list for checkpoints and resumes
+                        generated_parts = []
+                        if session_id in session_cache:
+                            session_cache[session_id]['generated_parts'] = generated_parts
                         start_time = time.time()
                         chunk_count = 0
                         
@@ -954,6 +1071,8 @@ def process_stream():
                         html_segments = []
                         current_segment = ""
                         current_segment_size = 0
+                        segment_sent = 0  # Characters of current_segment already sent as partial deltas
+                        last_send_time = time.monotonic()
                         segment_counter = 0
                         max_segment_size = MAX_SEGMENT_SIZE  # 16KB per segment
                         
@@ -972,33 +1091,23 @@ def process_stream():
                                     session_cache[session_id]['last_updated'] = current_time
                                     session_cache[session_id]['chunk_count'] = chunk_count
                                 
-                                # More frequent keepalive messages (every STREAM_CHUNK_SIZE chunks)
+                                # More frequent keepalive messages (every STREAM_CHUNK_SIZE chunks),
+                                # sent as an SSE comment line so no JSON is built per ping
                                 if chunk_count % STREAM_CHUNK_SIZE == 0:
-                                    yield format_stream_event("keepalive", {
-                                        "timestamp": current_time,
-                                        "session_id": session_id,
-                                        "chunk_count": chunk_count
-                                    })
+                                    yield SSE_PING
                                 
                                 # Handle thinking updates
                                 if hasattr(chunk, "thinking") and chunk.thinking:
-                                    thinking_data = {
-                                        "type": "thinking_update",
-                                        "chunk_id": f"{message_id}_{chunk_count}",
-                                        "thinking": {
-                                            "content": chunk.thinking.content if hasattr(chunk.thinking, "content") else ""
-                                        }
-                                    }
-                                    yield format_stream_event("content", thinking_data)
+                                    # Pre-encoded like the deltas; the chunk id reuses the encoder's prefix
+                                    yield encoder.thinking_update(
+                                        chunk.thinking.content if hasattr(chunk.thinking, "content") else "",
+                                        chunk_count
+                                    )
                                 
                                 # Handle content block deltas (the actual generated text)
                                 if hasattr(chunk, "delta") and hasattr(chunk.delta, "text"):
                                     delta_text = chunk.delta.text
-                                    generated_text += delta_text
-                                    
-                                    # Update session cache with generated text
-                                    if session_id in session_cache:
-                                        session_cache[session_id]['generated_text'] = generated_text
+                                    generated_parts.append(delta_text)
                                     
                                     # Check if we need to create a checkpoint (every 2 minutes)
                                     if current_time - last_checkpoint_time > CHECKPOINT_INTERVAL:
@@ -1008,8 +1117,10 @@ def process_stream():
                                         
                                         # Store checkpoint in the session cache
                                         session_cache[session_id]["checkpoints"] = session_cache[session_id].get("checkpoints", {})
+                                        html_so_far = "".join(generated_parts)
+                                        session_cache[session_id]['generated_text'] = html_so_far
                                         session_cache[session_id]["checkpoints"][checkpoint_id] = {
-                                            "html_so_far": generated_text,
+                                            "html_so_far": html_so_far,
                                             "chunk_id": f"{message_id}_{chunk_count}",
                                             "timestamp": current_time,
                                             "chunk_count": chunk_count
@@ -1051,49 +1162,30 @@ def process_stream():
                                         if session_id in session_cache:
                                             session_cache[session_id]['html_segments'] = html_segments.copy()
                                         
-                                        # Send segment to client
-                                        content_data = {
-                                            "type": "content_block_delta",
-                                            "chunk_id": f"{message_id}_{chunk_count}",
-                                            "delta": {
-                                                "text": current_segment
-                                            },
-                                            "segment": segment_counter,
-                                            "session_id": session_id,
-                                            "chunk_count": chunk_count
-                                        }
-                                        yield format_stream_event("content", content_data)
+                                        # Send the rest of the segment (partial deltas already carried the start)
+                                        yield encoder.content_delta(current_segment[segment_sent:], chunk_count, segment=segment_counter)
+                                        last_send_time = time.monotonic()
                                         
                                         # Send a keepalive after every segment to maintain connection
-                                        yield format_stream_event("keepalive", {
-                                            "timestamp": time.time(),
-                                            "session_id": session_id,
-                                            "chunk_count": chunk_count,
-                                            "segment": segment_counter
-                                        })
+                                        yield SSE_PING
                                         
                                         # Reset for next segment
                                         current_segment = ""
                                         current_segment_size = 0
+                                        segment_sent = 0
                                         
                                         # Add a short sleep to let the browser process
                                         if segment_counter % 3 == 0:  # Reduced from 5 to 3
                                             time.sleep(0.05)
                                     
-                                    # For smaller updates, send frequently to maintain connection
-                                    # Send even small updates every 2 chunks (reduced from 5)
-                                    elif chunk_count % 2 == 0 and current_segment:
-                                        content_data = {
-                                            "type": "content_block_delta",
-                                            "chunk_id": f"{message_id}_{chunk_count}",
-                                            "delta": {
-                                                "text": current_segment
-                                            },
-                                            "partial": True,
-                                            "session_id": session_id,
-                                            "chunk_count": chunk_count
-                                        }
-                                        yield format_stream_event("content", content_data)
+                                    # For smaller updates, send the unsent text once enough bytes have
+                                    # built up or it has waited long enough, rather than every N chunks
+                                    elif (current_segment_size - segment_sent >= PARTIAL_FLUSH_SIZE or
+                                          (current_segment_size > segment_sent and
+                                           time.monotonic() - last_send_time >= PARTIAL_FLUSH_INTERVAL)):
+                                        yield encoder.content_delta(current_segment[segment_sent:], chunk_count, partial=True)
+                                        segment_sent = current_segment_size
+                                        last_send_time = time.monotonic()
                                 
                             except (ConnectionError, BrokenPipeError) as e:
                                 app.logger.error(f"Client disconnected during streaming: {str(e)}")
@@ -1102,7 +1194,7 @@ def process_stream():
                                 
                                 # Make sure session cache is updated before breaking
                                 if session_id in session_cache:
-                                    session_cache[session_id]['generated_text'] = generated_text
+                                    session_cache[session_id]['generated_text'] = "".join(generated_parts)
                                     session_cache[session_id]['html_segments'] = html_segments.copy()
                                     session_cache[session_id]['chunk_count'] = chunk_count
                                 break
@@ -1111,17 +1203,14 @@ def process_stream():
                         if current_segment:
                             html_segments.append(current_segment)
                             segment_counter += 1
-                            content_data = {
-                                "type": "content_block_delta",
-                                "chunk_id": f"{message_id}_{chunk_count}",
-                                "delta": {
-                                    "text": current_segment
-                                },
-                                "segment": segment_counter,
-                                "session_id": session_id,
-                                "chunk_count": chunk_count
-                            }
-                            yield format_stream_event("content", content_data)
+                            # Skip the frame when partial deltas already carried the whole segment
+                            if segment_sent < len(current_segment):
+                                yield encoder.content_delta(current_segment[segment_sent:], chunk_count, segment=segment_counter)
+                        
+                        # Join the generated parts once, now that this attempt has finished
+                        generated_text = "".join(generated_parts)
+                        if session_id in session_cache:
+                            session_cache[session_id]['generated_text'] = generated_text
                         
                         # If we completed the stream successfully and have content
                         if len(generated_text) > 0:
@@ -1157,7 +1246,6 @@ def process_stream():
                                     yield format_stream_event("status", {
                                         "type": "status", 
                                         "message": f"Anthropic API temporarily overloaded. Retrying in {wait_time:.1f}s (attempt {retry_count}/{max_retries})...",
-                                        "session_id": session_id,
                                         "retry": retry_count,
                                         "max_retries": max_retries
                                     })
@@ -1170,8 +1258,7 @@ def process_stream():
                                         "type": "error",
                                         "error": "Maximum retry attempts exceeded. Please try again later.",
                                         "details": "The AI service is currently experiencing high load. Your request could not be completed after multiple attempts.",
-                                        "code": 529,
-                                        "session_id": session_id
+                                        "code": 529
                                     })
                                     return
                         except Exception as json_err:
@@ -1186,8 +1273,7 @@ def process_stream():
                     yield format_stream_event("error", {
                         "type": "error",
                         "error": error_str,
-                        "details": str(error_details),
-                        "session_id": session_id
+                        "details": str(error_details)
                     })
                     return
             
@@ -1224,24 +1310,23 @@ def process_stream():
                     "message_id": message_id,
                     "chunk_id": f"{message_id}_{chunk_count}",
                     "usage": usage_data,
-                    "html": generated_text,
                     "session_id": session_id,
                     "final_chunk_count": chunk_count,
                     "segment_count": segment_counter
                 }
-                yield format_stream_event("content", complete_data)
+                yield format_complete_event(complete_data, generated_text)
                 yield format_stream_event("stream_end", {"message": "Stream complete", "session_id": session_id})
             except (ConnectionError, BrokenPipeError) as e:
                 app.logger.error(f"Client disconnected during completion: {str(e)}")
         except Exception as e:
-            app.logger.error(f"Unexpected error in stream generator: {str(e)}")
-            # Include stack trace for better debugging
-            app.logger.error(traceback.format_exc())
+            app.logger.error(f"Unexpected error in stream generator: {type(e).__name__}: {str(e)}")
+            # Include stack trace for better debugging (logged only, never sent to the client)
+            if STREAM_DEBUG:
+                app.logger.error(traceback.format_exc())
             yield format_stream_event("error", {
                 "type": "error",
                 "error": str(e),
-                "details": traceback.format_exc(),
-                "session_id": session_id
+                "error_type": type(e).__name__
             })
     
     # Generator for resuming from cache
@@ -1295,7 +1380,7 @@ def process_stream():
                     "message_id": session_id,
                     "chunk_id": f"{session_id}_{len(html_segments) * 10}",
                     "usage": cached_data.get('usage', {}),
-                    "html": cached_data.get('generated_text', ''),
+                    "html": session_generated_text(cached_data),
                     "session_id": session_id,
                     "final_chunk_count": len(html_segments) * 10,
                     "segment_count": len(html_segments),
@@ -1359,8 +1444,13 @@ def process_stream():
             yield from stream_generator()
     
     # Return streaming response
-    response = Response(stream_with_context(stream_generator()), 
+    # The generator only uses values captured above (no flask.request access),
+    # so it is passed directly instead of through stream_with_context, which
+    # would push/pop the request context around every yielded event.
+    # coalesce_sse batches small deltas so each socket write carries more content.
+    response = Response(coalesce_sse(stream_generator()), 
                          content_type='text/event-stream')
+    response.headers['X-Session-Id'] = session_id  # Sent once here instead of in every frame
     response.headers['X-Accel-Buffering'] = 'no'  # Disable nginx buffering
     response.headers['Cache-Control'] = 'no-cache, no-transform'
     response.headers['Connection'] = 'keep-alive'
@@ -1594,7 +1684,40 @@ def test_generate():
             "test_mode": True
         }), 200  # Return 200 for better client handling
 
-def gemini_task(api_key, content, format_prompt, max_tokens, temperature,new_guid):
+# One google-genai client per API key, reused by later jobs so they share its
+# pooled HTTPS connections instead of opening a new TLS session per generation.
+# Keyed by the hash of the API key (never the key itself) and bounded like the
+# helper's service client cache, dropping the least recently used client first.
+GENAI_CLIENTS = collections.OrderedDict()
+GENAI_CLIENTS_LOCK = threading.Lock()
+
+def get_genai_client(api_key):
+    key_hash = gemini_key_hash(api_key)
+    with GENAI_CLIENTS_LOCK:
+        client = GENAI_CLIENTS.get(key_hash)
+        if client is not None:
+            GENAI_CLIENTS.move_to_end(key_hash)
+            return client
+    client = genai.Client(api_key=api_key)
+    with GENAI_CLIENTS_LOCK:
+        GENAI_CLIENTS[key_hash] = client
+        while len(GENAI_CLIENTS) > GEMINI_CLIENT_CACHE_SIZE:
+            GENAI_CLIENTS.popitem(last=False)
+    return client
+
+def forget_genai_client(api_key):
+    """Drop the cached google-genai client of api_key, e.g. after it failed authentication"""
+    with GENAI_CLIENTS_LOCK:
+        GENAI_CLIENTS.pop(gemini_key_hash(api_key), None)
+
+# Generation config for the background job, built once. The system instruction is
+# sent in the config as a system turn rather than pasted into every user prompt.
+GEMINI_TASK_CONFIG = types.GenerateContentConfig(
+    response_mime_type="text/plain",
+    system_instruction=SYSTEM_INSTRUCTION,
+)
+
+def gemini_task(api_key, content, format_prompt, max_tokens, temperature,new_guid, cache_key=None, semantic_key=None, model_name=GEMINI_MODEL):
     try:
 
         # Prepare user message with content and additional prompt
@@ -1602,16 +1725,13 @@ def gemini_task(api_key, content, format_prompt, max_tokens, temperature,new_gui
         if format_prompt:
             user_content = f"{user_content}\n\n{format_prompt}"
 
-        # Create the prompt
-        prompt = f"""
-{SYSTEM_INSTRUCTION}
-
-Here is the content to transform into a website:
+        # Create the prompt (the system instruction travels in GEMINI_TASK_CONFIG)
+        prompt = f"""Here is the content to transform into a website:
 
 {user_content}
 """
         # Generate content
-        print(f"Generating content with {GEMINI_MODEL}, max_tokens={max_tokens}, temperature={temperature}")
+        app.logger.info("Generating content with %s, max_tokens=%d, temperature=%s", model_name, max_tokens, temperature)
 
         contents = [
             types.Content(
@@ -1621,26 +1741,21 @@ Here is the content to transform into a website:
                 ],
             ),
         ]
-        client = genai.Client(
-            api_key=api_key,
-        )
-        model = "gemini-2.5-pro"
-        generate_content_config = types.GenerateContentConfig(
-            response_mime_type="text/plain",
-        )
-
-        result_str = ''
+        client = get_genai_client(api_key)
+        model = model_name
+
+        # Collect chunks in a list and join once to avoid quadratic string concatenation
+        result_parts = []
         for chunk in client.models.generate_content_stream(
                 model=model,
                 contents=contents,
-                config=generate_content_config,
+                config=GEMINI_TASK_CONFIG,
         ):
-            result_str+=chunk.text
-            print('\n\n\n')
-            print(result_str)
+            if chunk.text:
+                result_parts.append(chunk.text)
 
         # Extract the HTML from the response
-        html_content = result_str
+        html_content = "".join(result_parts)
 
         # Try multiple approaches to extract content
         # if hasattr(response, 'text'):
@@ -1651,72 +1766,48 @@ Here is the content to transform into a website:
         # Clean HTML content if it contains markdown-style code blocks
         if html_content and ('```html' in html_content or '```' in html_content):
             # Extract the actual HTML from between the markdown code blocks
-            print("Detected markdown code blocks in Gemini response, extracting HTML...")
+            app.logger.info("Detected markdown code blocks in Gemini response, extracting HTML...")
 
             # First try with ```html specific tag
             html_match = re.search(r'```html\s*([\s\S]*?)\s*```', html_content)
             if html_match and html_match[1]:
                 html_content = html_match[1].strip()
-                print(f"Extracted HTML from markdown code blocks, new length: {len(html_content)}")
+                app.logger.info("Extracted HTML from markdown code blocks, new length: %d", len(html_content))
             else:
                 # Try with just ``` blocks
                 html_match = re.search(r'```\s*([\s\S]*?)\s*```', html_content)
                 if html_match and html_match[1]:
                     html_content = html_match[1].strip()
-                    print(f"Extracted HTML from generic markdown blocks, new length: {len(html_content)}")
+                    app.logger.info("Extracted HTML from generic markdown blocks, new length: %d", len(html_content))
 
         # If we still don't have content, use string representation
         if not html_content:
-            print("Warning: Could not extract HTML content using standard methods")
+            app.logger.warning("Could not extract HTML content using standard methods")
             html_content = str(response)
 
         # Verify that the content looks like HTML
         if not html_content.strip().startswith('<') and not '<html' in html_content:
-            print(f"Warning: Content doesn't appear to be HTML. Content starts with: {html_content[:100]}")
+            app.logger.warning("Content doesn't appear to be HTML. Content starts with: %s", html_content[:100])
 
             # Attempt to fix by wrapping in HTML tags if it's just text content
             if not html_content.strip().startswith('<'):
-                print("Attempting to fix by wrapping in HTML tags")
-                html_content = f"""
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Generated Content</title>
-    <link href="https://cdn.jsdelivr.net/npm/tailwindcss@2.2.19/dist/tailwind.min.css" rel="stylesheet">
-</head>
-<body class="bg-gray-100 dark:bg-gray-900 text-gray-800 dark:text-gray-200">
-    <div class="container mx-auto p-4">
-        {html_content}
-    </div>
-    <script>
-        // Simple dark mode toggle
-        if (window.matchMedia && window.matchMedia('(prefers-color-scheme: dark)').matches) {{
-            document.documentElement.classList.add('dark');
-        }}
-    </script>
-</body>
-</html>
-"""
-
-        # Get usage stats (approximate since Gemini doesn't provide exact token counts)
-        input_tokens = len(prompt.split()) * 1.3  # Rough estimate: ~1.3 tokens per word
-        output_tokens = len(html_content.split()) * 1.3
+                app.logger.info("Attempting to fix by wrapping in HTML tags")
+                html_content = WRAPPED_HTML_TEMPLATE.format(body=html_content)
 
-        # Ensure we don't have zero tokens (minimum of source length / 3)
-        input_tokens = max(len(content.split()) * 1.3, input_tokens)
-
-        # Round to integers
-        input_tokens = max(1, int(input_tokens))
-        output_tokens = max(1, int(output_tokens))
+        # Get usage stats (approximate, from text length; the prompt already contains the content)
+        input_tokens = estimate_tokens(prompt)
+        output_tokens = estimate_tokens(html_content)
 
         # Log response
-        print(f"Successfully generated HTML with Gemini. Input tokens: {input_tokens}, Output tokens: {output_tokens}")
+        app.logger.info("Successfully generated HTML with Gemini. Input tokens: %d, Output tokens: %d", input_tokens, output_tokens)
 
-        print(html_content)
+        app.logger.debug("%s", html_content)
 
         result_cache[new_guid] = html_content
+        if cache_key:
+            cache_response(cache_key, html_content)
+        if semantic_key:
+            SEMANTIC_CACHE.add(*semantic_key, html_content)
 
         # Return the response
         # return {
@@ -1732,40 +1823,12 @@ Here is the content to transform into a website:
 
     except Exception as e:
         error_message = str(e)
-        traceback_str = traceback.format_exc()
-        print(f"Error in /api/process-gemini: {error_message}")
-        print(f"Traceback: {traceback_str}")
+        app.logger.error("Error in /api/process-gemini: %s", error_message, exc_info=True)
+        if forget_gemini_models_on_auth_error(e, api_key):
+            forget_genai_client(api_key)
 
         # Create a graceful fallback error page as HTML
-        error_html = f"""
-        <!DOCTYPE html>
-        <html lang="en">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>Error Processing Content</title>
-            <link href="https://cdn.jsdelivr.net/npm/tailwindcss@2.2.19/dist/tailwind.min.css" rel="stylesheet">
-        </head>
-        <body class="bg-gray-100 dark:bg-gray-900 text-gray-800 dark:text-gray-200">
-            <div class="container mx-auto p-8 max-w-3xl">
-                <div class="bg-white dark:bg-gray-800 p-6 rounded-lg shadow-lg">
-                    <h1 class="text-2xl font-bold text-red-600 mb-4">Error Processing Content</h1>
-                    <p class="mb-4">There was an error processing your content with the Gemini API:</p>
-                    <div class="bg-gray-100 dark:bg-gray-700 p-4 rounded overflow-auto mb-4">
-                        <code class="text-sm">{error_message}</code>
-                    </div>
-                    <p class="mb-2">Possible solutions:</p>
-                    <ul class="list-disc pl-5 mb-4">
-                        <li>Try again with a smaller content size</li>
-                        <li>Check your Gemini API key</li>
-                        <li>Try with a different content format</li>
-                        <li>Switch to the Claude API if available</li>
-                    </ul>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
+        error_html = GEMINI_ERROR_HTML_TEMPLATE.format(error_message=error_message)
 
         result_cache[new_guid] = error_html
         # Return error as both JSON and HTML
@@ -1784,10 +1847,13 @@ def process_gemini_result():
     # Extract the API key and content
     uuid = data.get('uuid')
 
-    if uuid in result_cache:
-        return jsonify({"html": result_cache[uuid]}), 200
+    # Hand each finished result out once and drop it, so completed pages don't
+    # accumulate in memory (the client stops polling as soon as it gets the html)
+    html = result_cache.pop(uuid, None)
+    if html is not None:
+        return jsonify({"html": html, "status": "done"}), 200
     else:
-        return jsonify({"html": None}), 200
+        return jsonify({"html": None, "status": "pending"}), 200
 
 
 @app.route('/api/process-gemini', methods=['POST'])
@@ -1796,7 +1862,7 @@ def process_gemini():
     Process a file using the Google Gemini API and return HTML.
     """
     # Get the data from the request
-    print("\n==== API PROCESS GEMINI REQUEST RECEIVED ====")
+    app.logger.info("==== API PROCESS GEMINI REQUEST RECEIVED ====")
     data = request.get_json()
 
     if not data:
@@ -1808,8 +1874,9 @@ def process_gemini():
     format_prompt = data.get('format_prompt', '')
     max_tokens = int(data.get('max_tokens', GEMINI_MAX_OUTPUT_TOKENS))
     temperature = float(data.get('temperature', GEMINI_TEMPERATURE))
+    model_name = select_gemini_model(data.get('model'), content or '', GEMINI_MODEL)
 
-    print(f"Processing Gemini request with max_tokens={max_tokens}, content_length={len(content) if content else 0}")
+    app.logger.info("Processing Gemini request with max_tokens=%d, content_length=%d", max_tokens, len(content) if content else 0)
 
     # Check if we have the required data
     if not api_key or not content:
@@ -1822,13 +1889,34 @@ def process_gemini():
         }), 500
 
     new_guid = str(uuid.uuid4())
+    
+    # Identical requests are answered from the response cache without a new generation
+    cache_key = response_cache_key(gemini_key_hash(api_key), model_name, max_tokens, temperature, content, format_prompt)
+    cached_html = get_cached_response(cache_key)
+    if cached_html is not None:
+        app.logger.info("Serving Gemini result from the response cache")
+        result_cache[new_guid] = cached_html
+        return jsonify({"status": "Task started","uuid":new_guid}), 202, {'X-Cache': 'HIT'}
+    
+    # Near-duplicate content can be answered from the semantic cache (opt-in)
+    semantic_key = None
+    semantic_vector = SEMANTIC_CACHE.embed(api_key, content) if SEMANTIC_CACHE_ENABLED else None
+    if semantic_vector is not None:
+        semantic_key = (response_cache_key(gemini_key_hash(api_key), model_name, max_tokens, temperature, format_prompt),
+                        semantic_vector, content)
+        similar_html = SEMANTIC_CACHE.lookup(*semantic_key)
+        if similar_html is not None:
+            result_cache[new_guid] = similar_html
+            return jsonify({"status": "Task started","uuid":new_guid}), 202, {'X-Cache': 'SEMANTIC'}
+    
     # Start the task in a new thread
-    task_thread = threading.Thread(target=gemini_task, args=(api_key, content, format_prompt, max_tokens, temperature,new_guid))
+    # (daemon, so a generation still running does not hold up server shutdown)
+    task_thread = threading.Thread(target=gemini_task, args=(api_key, content, format_prompt, max_tokens, temperature,new_guid, cache_key, semantic_key, model_name), daemon=True)
     task_thread.start()
     #task_thread.join()
 
     # Return a response indicating the task has started
-    return jsonify({"status": "Task started","uuid":new_guid}), 202
+    return jsonify({"status": "Task started","uuid":new_guid}), 202, {'X-Cache': 'MISS'}
 
 
 # # Add a new route for Gemini API processing
@@ -1875,87 +1963,69 @@ def process_gemini_stream():
     """
     Process a streaming request using Google Gemini API.
     """
-    # Extract request data
-    data = request.get_json()
-    api_key = data.get('api_key')
-    
-    # Check for both 'content' and 'source' parameters for compatibility
-    content = data.get('content', '')
-    if not content:
-        content = data.get('source', '')  # Fallback to 'source' if 'content' is empty
-    
-    # If content is empty, return an error
-    if not content:
-        return jsonify({"success": False, "error": "Source code or text is required"}), 400
-    
-    format_prompt = data.get('format_prompt', '')
-    max_tokens = int(data.get('max_tokens', GEMINI_MAX_OUTPUT_TOKENS))
-    temperature = float(data.get('temperature', GEMINI_TEMPERATURE))
-    
-    # Reconnection support
-    session_id = data.get('session_id', str(uuid.uuid4()))
-    
     # Check if Gemini is available
     if not GEMINI_AVAILABLE:
         return jsonify({
             'error': 'Google Generative AI package is not installed on the server.'
         }), 500
     
-    # Create Gemini client
-    try:
-        client = create_gemini_client(api_key)
-    except Exception as e:
-        return jsonify({
-            "success": False,
-            "error": f"API key validation failed: {str(e)}"
-        })
-    
-    # Initialize session cache for this request
-    session_cache[session_id] = {
-        'created_at': time.time(),
-        'last_updated': time.time(),
-        'html_segments': [],
-        'generated_text': '',
-        'chunk_count': 0,
-        'user_content': content[:100000],  # Store for potential reconnection
-        'format_prompt': format_prompt,
-        'model': GEMINI_MODEL,
-        'max_tokens': max_tokens,
-        'temperature': temperature
-    }
+    # Extract and validate request data in one pass
+    params, error_msg = parse_gemini_request(load_json_body(request.get_data()), GEMINI_MAX_OUTPUT_TOKENS, GEMINI_TEMPERATURE)
+    if error_msg:
+        return jsonify({"success": False, "error": error_msg}), 400
     
-    # Prepare prompt
-    prompt = f"""
-{SYSTEM_INSTRUCTION}
-
-Here is the content to transform into a website:
-
-{content[:100000]}
-"""
+    api_key = params['api_key']
+    content = params['content']
+    format_prompt = params['format_prompt']
+    max_tokens = params['max_tokens']
+    temperature = params['temperature']
+    model_name = select_gemini_model(params['model'], content, GEMINI_MODEL)
+    session_id = params['session_id']  # Reconnection support
     
-    if format_prompt:
-        prompt += f"\n\n{format_prompt}"
+    # GeminiSSEStream calls the REST endpoint with the key directly; no SDK model is needed
+    if not api_key or not isinstance(api_key, str):
+        return jsonify({"success": False, "error": "API key is required"}), 400
     
     # Define the streaming response generator
     def gemini_stream_generator():
         try:
-            yield format_stream_event("stream_start", {"message": "Stream starting", "session_id": session_id})
+            # Send stream_start before any prompt work so the client gets its first byte sooner
+            yield stream_start_event(session_id)
             
-            # Get the model
-            model = client.get_model(GEMINI_MODEL)
+            # Truncate once and reuse the result for the cache and the prompt;
+            # the slice copies the string, so it only runs when the content is too long
+            user_content = truncate_to_token_budget(content, GEMINI_CONTENT_TOKEN_BUDGET)
+            if user_content is not content:
+                app.logger.info("Truncated content from %d to %d characters", len(content), len(user_content))
             
-            # Configure generation parameters
-            generation_config = {
-                "max_output_tokens": max_tokens,
-                "temperature": temperature,
-                "top_p": GEMINI_TOP_P,
-                "top_k": GEMINI_TOP_K
+            # Initialize session cache for this request
+            session_cache[session_id] = {
+                'created_at': time.time(),
+                'last_updated': time.time(),
+                'html_segments': [],
+                'generated_text': '',
+                'chunk_count': 0,
+                'user_content': user_content,  # Store for potential reconnection
+                'format_prompt': format_prompt,
+                'model': model_name,
+                'max_tokens': max_tokens,
+                'temperature': temperature
             }
             
+            # Prepare prompt: SYSTEM_INSTRUCTION goes in Gemini's system slot (see GeminiSSEStream),
+            # so the user content is sent as-is unless a format prompt is appended
+            prompt = user_content
+            
+            if format_prompt:
+                prompt += f"\n\n{format_prompt}"
+            
+            # Configure generation parameters
+            generation_config = gemini_generation_config(GEMINI_GENERATION_CONFIG, max_tokens, temperature)
+            
             # Generate content with streaming
             try:
-                print(f"Starting Gemini content generation with model {GEMINI_MODEL}")
-                print(f"Generation config: max_tokens={generation_config['max_output_tokens']}, temp={generation_config['temperature']}")
+                app.logger.info("Starting Gemini content generation with model %s", model_name)
+                app.logger.debug("Generation config: max_tokens=%s, temp=%s", generation_config['max_output_tokens'], generation_config['temperature'])
                 
                 # Use more reliable safety settings to prevent empty responses
                 safety_settings = {
@@ -1965,28 +2035,31 @@ Here is the content to transform into a website:
                     "dangerous": "block_none",
                 }
                 
-                # Generate content with the specified configurations
-                stream_response = model.generate_content(
+                # Stream from the REST endpoint directly; GeminiSSEStream yields the text of
+                # each event without building the SDK's response objects per chunk
+                stream_response = GeminiSSEStream(
+                    api_key,
+                    model_name,
                     prompt,
                     generation_config=generation_config,
                     safety_settings=safety_settings,
-                    stream=True
+                    system_instruction=SYSTEM_INSTRUCTION
                 )
                 
                 # Log success
-                print("Successfully created Gemini stream response object")
+                app.logger.debug("Successfully created Gemini stream response object")
                 
                 # Use our custom streaming response class
                 with GeminiStreamingResponse(stream_response, session_id) as gemini_stream:
-                    print(f"Entering GeminiStreamingResponse context with session ID: {session_id}")
+                    app.logger.debug("Entering GeminiStreamingResponse context with session ID: %s", session_id)
                     chunk_count = 0
                     for chunk in gemini_stream:
                         chunk_count += 1
                         if chunk_count % 10 == 0:
-                            print(f"Processed {chunk_count} chunks from Gemini stream")
+                            app.logger.debug("Processed %d chunks from Gemini stream", chunk_count)
                         yield chunk
                     
-                    print(f"Completed streaming {chunk_count} chunks from Gemini")
+                    app.logger.info("Completed streaming %d chunks from Gemini", chunk_count)
                     # Stream end event
                     yield format_stream_event("stream_end", {
                         "message": "Stream complete",
@@ -1994,31 +2067,29 @@ Here is the content to transform into a website:
                     })
             except Exception as e:
                 error_message = str(e)
-                print(f"Error during Gemini content generation: {error_message}")
-                traceback_str = traceback.format_exc()
-                print(f"Traceback: {traceback_str}")
+                app.logger.error("Error during Gemini content generation: %s", error_message, exc_info=True)
+                forget_gemini_models_on_auth_error(e, api_key)
                 
                 yield format_stream_event("error", {
                     "type": "error",
-                    "error": error_message,
-                    "details": traceback_str,
-                    "session_id": session_id
+                    "error": error_message
                 })
             
         except Exception as e:
             error_message = str(e)
-            print(f"Error in gemini_stream_generator: {error_message}")
+            app.logger.error("Error in gemini_stream_generator: %s", error_message, exc_info=True)
             
             yield format_stream_event("error", {
                 "type": "error",
-                "error": error_message,
-                "session_id": session_id
+                "error": error_message
             })
     
-    # Return the streaming response
+    # Return the streaming response (the generator does not touch flask.request);
+    # coalesce_sse batches small deltas so each socket write carries more content
     return Response(
-        stream_with_context(gemini_stream_generator()),
-        content_type='text/event-stream'
+        coalesce_sse(gemini_stream_generator()),
+        content_type='text/event-stream',
+        headers={'X-Session-Id': session_id}  # Sent once here instead of in every frame
     )
 
 @app.route('/api/version', methods=['GET'])
@@ -2046,11 +2117,9 @@ if __name__ == "__main__":
     # Parse arguments
     args = parser.parse_args()
     
-    # Configure logging for better debugging
-    logging.basicConfig(
-        level=logging.INFO if not args.debug else logging.DEBUG,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )
+    # Logging is configured at import (LOG_LEVEL); --debug turns on debug output
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
     
     # Configure longer timeouts to handle large content
     from werkzeug.serving import run_simple
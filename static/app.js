@@ -1302,6 +1302,7 @@ async function generateGeminiHTMLStream(apiKey, source, formatPrompt, maxTokens,
                                 console.log('Using complete HTML from completion event');
                                 // Use the complete HTML from the event, which might have better formatting
                                 generatedContent = eventData.html;
+                                hasReceivedContent = true;
                                 state.generatedHtml = generatedContent;
                                 updateHtmlDisplay(generatedContent);
                             }
@@ -1746,6 +1747,9 @@ async function generateHTMLStreamWithReconnection(apiKey, source, formatPrompt,
                             break;
                         }
                         
+                        // Any bytes (including ": ping" comment lines) mean the connection is alive
+                        lastKeepAliveTime = Date.now();
+                        
                         // Decode the chunk
                         const chunk = decoder.decode(value, { stream: true });
                         console.log('Received chunk:', chunk.substring(0, 50) + '...');
@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("requests")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helper_function import SemanticResponseCache, gemini_key_hash, response_cache_key
+
+CONTENT = "Quarterly report for Acme Corp. Revenue grew 12% to $4.5M in 2024 across 3 regions."
+VECTOR = [0.6, 0.8, 0.0]
+NEARBY_VECTOR = [0.6, 0.79, 0.1]
+
+
+def bucket(api_key="key-a", format_prompt="dashboard"):
+    return response_cache_key(gemini_key_hash(api_key), "gemini-2.5-pro", 1000, 0.5, format_prompt)
+
+
+def cache_with_page():
+    cache = SemanticResponseCache(threshold=0.9)
+    cache.add(bucket(), VECTOR, CONTENT, "<html>cached</html>")
+    return cache
+
+
+def test_reformatted_content_hits():
+    cache = cache_with_page()
+    assert cache.lookup(bucket(), NEARBY_VECTOR, CONTENT.replace(". ", ".  ")) == "<html>cached</html>"
+
+
+def test_small_edit_does_not_hit():
+    cache = cache_with_page()
+    # Same length, near-identical embedding, but a different figure
+    assert cache.lookup(bucket(), NEARBY_VECTOR, CONTENT.replace("12%", "13%")) is None
+    assert cache.lookup(bucket(), NEARBY_VECTOR, CONTENT.replace("Acme", "Apex")) is None
+    assert cache.lookup(bucket(), NEARBY_VECTOR, CONTENT + " Outlook is stable.") is None
+
+
+def test_entries_are_scoped_per_key_and_prompt():
+    cache = cache_with_page()
+    assert cache.lookup(bucket(api_key="key-b"), VECTOR, CONTENT) is None
+    assert cache.lookup(bucket(format_prompt="timeline"), VECTOR, CONTENT) is None